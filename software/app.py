@@ -1,5 +1,6 @@
 from flask import Flask, send_from_directory, request, jsonify
 from calibration_setup import calibrate
+from gcode_sender.connection import get_connection
 
 app = Flask(__name__, static_folder='./web_server/static', static_url_path='/')
 
@@ -23,11 +24,17 @@ def api():
     # Return success
     return jsonify({'success': True})
 
+# Live printer data, optional ?seconds= for the temperature history
 @app.route("/api/monitor")
 def monitor(): 
-    data = request.get_json()
+    telemetry = get_connection().telemetry
+    seconds = request.args.get('seconds', type=float)
 
-    return jsonify({'success': True})
+    data = telemetry.snapshot()
+    if seconds is not None: 
+        data['history'] = telemetry.history(seconds)
+
+    return jsonify({'success': True, 'telemetry': data})
 
 # Use this 
 # flask run --host=0.0.0.0
\ No newline at end of file
@@ -1,8 +1,5 @@
-import RPi.GPIO as GPIO
 from optimization import optimize, fitness
-from load_cell.mass import tare, measure_mass
-
-GPIO.setmode(GPIO.BCM)  # set GPIO pin mode to BCM numbering
+from load_cell.mass import tare, close
 
 #MAIN BLOCK
 # Settings
@@ -69,12 +66,8 @@ def calibrate(numIterations):
 
         print('Starting Iteration {}'.format(i))
         
-        # Tare Load Cells
+        # Tare Load Cells, drift after the tare is corrected by the scale
         tare()
-        mass = measure_mass()
-        while mass > 1 and i == 1: 
-            tare()
-        # print("Tared Mass: {}".format(mass)) # Should be near 0 
 
         if i == 0: 
             xguess_i = xguess
@@ -88,6 +81,11 @@ def calibrate(numIterations):
 
         input('Please remove prints and press enter to continue: \n')
 
-calibrate(10)
+if __name__ == '__main__':
+    import RPi.GPIO as GPIO  # import GPIO, set up by load_cell on the first measurement
 
-GPIO.cleanup()
\ No newline at end of file
+    try: 
+        calibrate(10)
+    finally: 
+        close() # the sampling thread must not read the pins while they are released
+        GPIO.cleanup()
\ No newline at end of file
@@ -1,8 +1,8 @@
-import cv2
 import numpy as np
 import time
 import math
-from scipy import ndimage
+
+# cv2 and scipy are imported by the functions that use them, importing this module stays cheap
 
 # Tuning parameters 
 # LIGHTS ON/OFF
@@ -15,6 +15,7 @@ else:
     cannyThres2 = 200
 
 def capture(numCapture): 
+    import cv2
 
     cap = cv2.VideoCapture(0) # Setup
     ret, frame = cap.read() # Take image and store in variable
@@ -26,6 +27,8 @@ def capture(numCapture):
         cap.release() # Release
 
 def image_process(): 
+    import cv2
+    from scipy import ndimage
     # Capture 5 images
     numCapture = 1
     for i in range(0, numCapture): 
@@ -60,9 +63,11 @@ def image_process():
     return final
 
 def edges(img):
+    import cv2
     return cv2.Canny(img, threshold1=cannyThres1, threshold2=cannyThres2) # Canny Edge Detection
 
 def analyze_edge(edges): 
+    import cv2
     # Using Houghlines, Find Houghlines using Canny Edges
     lines = cv2.HoughLines(edges, 1, np.pi/180, 150)
 
@@ -118,6 +123,7 @@ def analyze_edge(edges):
     
 # Find Dimension of the Printed Part  
 def find_dim(x, y, distanceX, edges, iter): 
+    import cv2
 
     length = 0
     width = 0
@@ -230,6 +236,7 @@ def find_dim(x, y, distanceX, edges, iter):
 # ----------------------------------------------------------------------- # 
 
 def draw_hough(lines, edges, filename): 
+    import cv2
     cEdges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
 
     if lines is not None:
@@ -0,0 +1,80 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from gcode_sender.connection import PrinterConnection, get_connection
+from gcode_sender.printcore_gcode_sender import send_gcode
+
+# Printer Farm
+# A station is a printer with its own scale and camera. Particles are handed to whichever station is
+# free, so an iteration takes about as long as its particles divided by the number of stations.
+# Printing and waiting on the printer release the GIL, so one thread per station is enough.
+
+class Station:
+    def __init__(self, name, connection=None, tare=None, measure_mass=None, image_process=None, recent_mass=None):
+        self.name = name
+        self.connection = connection
+        self.tare = tare
+        self.measure_mass = measure_mass
+        self.image_process = image_process
+        self.recent_mass = recent_mass # unsettled reading of the scale while printing, None if the scale cannot do it
+
+        # Per station calibration, updated as the station prints
+        self.calibration = {
+            'zero': 0, # tare offset, g, the mass on the bed is counted from it
+            'ratio': None, # camera pixels per mm, used when the bed edge is not found in an image
+            'updated': None, # perf_counter of the last update
+        }
+        self.last_mass = 0 # mass on the bed after the last print, g
+        self.jobs = 0 # prints since the bed was cleared
+
+    def send(self, iter, lines, timeout=None, abort=None, progress=None):
+        return send_gcode(iter, lines, timeout=timeout, progress=progress, connection=self.connection, abort=abort)
+
+    def calibrate(self, **values):
+        self.calibration.update(values)
+        self.calibration['updated'] = perf_counter()
+
+    # Bed was cleared, start counting mass from zero again
+    def reset(self):
+        self.last_mass = 0
+        self.jobs = 0
+
+    def __repr__(self):
+        return 'Station({})'.format(self.name)
+
+# The station of this computer: printer on the Prusa port, load cells and camera of load_cell and cv
+def local_station():
+    from load_cell.mass import tare, measure_mass, recent_mass
+    from cv.dimensions import image_process
+    return Station('local', get_connection(), tare, measure_mass, image_process, recent_mass)
+
+# Station on another printer port, its scale and camera functions are passed in
+def remote_station(name, port, tare, measure_mass, image_process, baud=115200, recent_mass=None):
+    return Station(name, PrinterConnection(port, baud), tare, measure_mass, image_process, recent_mass)
+
+class Farm:
+    def __init__(self, stations):
+        self.stations = list(stations)
+
+    # Bed of every station was cleared
+    def reset(self):
+        for station in self.stations:
+            station.reset()
+
+    # fn(station, job) for every job, each on the next free station, results in job order
+    def map(self, fn, jobs):
+        free = queue.Queue()
+        for station in self.stations:
+            free.put(station)
+
+        def run(job):
+            station = free.get()
+            try:
+                return fn(station, job)
+            finally:
+                station.jobs += 1
+                free.put(station)
+
+        with ThreadPoolExecutor(max_workers=len(self.stations)) as executor:
+            return list(executor.map(run, jobs))
@@ -0,0 +1,96 @@
+import os
+import gzip
+import json
+import hashlib
+
+from gcode_gen.generate import settings
+from gcode_gen.template import renderProgram
+from gcode_gen.postprocess import optimizeProgram
+
+# Gcode Program Cache
+# Generated programs are stored gzipped on disk under a hash of everything that goes into them, so
+# re-runs and resumed campaigns reuse identical programs instead of regenerating them.
+# Least recently used programs are deleted once the cache is over its size limit.
+
+CACHE_VERSION = 2 # bump when the generator output changes, old entries are never hit again
+cache_dir = './gcode_gen/cache'
+max_size = 200*1024*1024 # bytes
+
+# Stable key for a program, the full settings (defaults included) are hashed so a change of the
+# defaults also changes the key
+def programKey(mode, iter, modified_settings, nozzleD, Te, Tb, optimize=False):
+    merged = dict(settings)
+    merged.update(modified_settings)
+
+    data = {
+        'version': CACHE_VERSION,
+        'mode': mode,
+        'iter': iter,
+        'settings': merged,
+        'nozzleD': nozzleD,
+        'Te': Te,
+        'Tb': Tb,
+        'optimize': optimize,
+    }
+    text = json.dumps(data, sort_keys=True, default=float) # numpy numbers as floats
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class GcodeCache:
+    def __init__(self, directory=None, maxSize=None):
+        self.directory = cache_dir if directory is None else directory
+        self.maxSize = max_size if maxSize is None else maxSize
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.gcode.gz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    # Store a program, written to a temp file first so a crash never leaves a broken entry
+    def put(self, key, gcode):
+        tmp = self.path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz: # no timestamp, same program gives the same file
+                gz.write(gcode.encode())
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    # Lines of a cached program, read lazily so it can be streamed to the printer
+    # Marks the program as used
+    def lines(self, key):
+        path = self.path(key)
+        os.utime(path)
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                yield line
+
+    def read(self, key):
+        return ''.join(self.lines(key))
+
+    # Delete the least recently used programs until the cache fits in maxSize
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.gcode.gz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxSize:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    # Key of a program, generated and stored if it is not cached yet
+    def program(self, mode, iter, modified_settings, nozzleD, Te, Tb, optimize=False):
+        key = programKey(mode, iter, modified_settings, nozzleD, Te, Tb, optimize)
+
+        if key not in self:
+            gcode = renderProgram(mode, iter, modified_settings, nozzleD, Te, Tb)
+            if optimize:
+                gcode = optimizeProgram(gcode)
+            self.put(key, gcode)
+
+        return key
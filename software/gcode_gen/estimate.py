@@ -0,0 +1,188 @@
+import re
+import numpy as np
+
+# Print Time Estimation
+# Simulates a program the way the firmware planner runs it, without touching the printer:
+# every move is a trapezoid (accelerate, cruise, decelerate) and the speed at the junction of two
+# moves is limited by the jerk of every axis. The limits start at the values genStart sends
+# (M201/M203/M204/M205) and are updated by those commands in the program.
+# Heating waits (M109/M190) are not included, the time is motion plus dwells (G4).
+
+WORD = re.compile(r'([A-Z])(-?[\d.]+)')
+AXES = ('X', 'Y', 'Z', 'E')
+EPSILON = 1e-9
+
+# Machine limits as set by genStart
+limits = {
+    'maxAccel': (1000, 1000, 200, 5000), # M201, mm/sec^2
+    'maxFeed': (200, 200, 12, 120), # M203, mm/sec
+    'printAccel': 1250, # M204 P
+    'retractAccel': 1250, # M204 R
+    'travelAccel': 1250, # M204 T
+    'jerk': (8, 8, 0.4, 4.5), # M205 X Y Z E, mm/sec
+    'minFeed': 0, # M205 S, mm/sec
+    'minTravelFeed': 0, # M205 T, mm/sec
+}
+
+class Estimate:
+    def __init__(self, moveTimes, filament, extruded, dwell, lineFilament=None):
+        self.moveTimes = moveTimes # seconds, one per move
+        self.filament = filament # net filament pushed, retractions included, mm
+        self.lineFilament = lineFilament # net filament pushed up to every gcode line (comments and blank lines skipped), mm
+        self.extruded = extruded # filament pushed by printing moves, mm
+        self.dwell = dwell # G4 waits, sec
+        self.time = float(moveTimes.sum()) + dwell # sec
+
+    def __repr__(self):
+        return 'Estimate(time={:.1f}s, moves={}, filament={:.2f}mm)'.format(self.time, len(self.moveTimes), self.filament)
+
+# Update the limits for a M201/M203/M204/M205 command
+def updateLimits(current, cmd, words):
+    new = dict(current)
+
+    if cmd in ('M201', 'M203', 'M205'):
+        key = {'M201': 'maxAccel', 'M203': 'maxFeed', 'M205': 'jerk'}[cmd]
+        new[key] = tuple(float(words[axis]) if axis in words else old for axis, old in zip(AXES, current[key]))
+
+    if cmd == 'M204':
+        if 'S' in words: # S sets both printing and travel acceleration
+            new['printAccel'] = new['travelAccel'] = float(words['S'])
+        if 'P' in words:
+            new['printAccel'] = float(words['P'])
+        if 'T' in words:
+            new['travelAccel'] = float(words['T'])
+        if 'R' in words:
+            new['retractAccel'] = float(words['R'])
+
+    if cmd == 'M205':
+        if 'S' in words:
+            new['minFeed'] = float(words['S'])
+        if 'T' in words:
+            new['minTravelFeed'] = float(words['T'])
+
+    return new
+
+# Moves of a program as arrays: axis deltas (X Y Z E), requested feedrate (mm/sec) and the limits in
+# effect for every move, and the net filament pushed up to every line that is sent
+def parseMoves(lines):
+    current = dict(limits)
+    pos = [0.0, 0.0, 0.0, 0.0]
+    feed = 0.0
+    absolute = True
+    relativeE = False
+    deltas, feeds, moveLimits = [], [], []
+    dwell = 0.0
+    pushed = 0.0
+    lineFilament = []
+
+    for line in lines:
+        code = line.split(';', 1)[0].strip()
+        if not code:
+            continue
+        cmd = code.split()[0]
+        words = dict(WORD.findall(code[len(cmd):]))
+
+        if cmd in ('G0', 'G1'):
+            feed = float(words['F'])/60 if 'F' in words else feed
+            delta = [0.0, 0.0, 0.0, 0.0]
+
+            for i, axis in enumerate(AXES):
+                if axis not in words:
+                    continue
+                value = float(words[axis])
+                relative = (relativeE or not absolute) if axis == 'E' else not absolute
+                delta[i] = value if relative else value - pos[i]
+                pos[i] += delta[i]
+            pushed += delta[3]
+
+            if any(abs(d) > EPSILON for d in delta):
+                deltas.append(delta)
+                feeds.append(feed)
+                moveLimits.append(current)
+
+        elif cmd in ('M201', 'M203', 'M204', 'M205'):
+            current = updateLimits(current, cmd, words)
+        elif cmd == 'G90':
+            absolute = True
+        elif cmd == 'G91':
+            absolute = False
+        elif cmd == 'M83':
+            relativeE = True
+        elif cmd == 'M82':
+            relativeE = False
+        elif cmd == 'G92':
+            for i, axis in enumerate(AXES):
+                if axis in words:
+                    pos[i] = float(words[axis])
+        elif cmd in ('G28', 'G80'):
+            pos[:3] = [0.0, 0.0, 0.0] # homing and leveling are not timed
+        elif cmd == 'G4':
+            dwell += float(words.get('S', 0)) + float(words.get('P', 0))/1000
+
+        lineFilament.append(pushed)
+
+    return np.array(deltas, dtype=float).reshape(-1, 4), np.array(feeds, dtype=float), moveLimits, dwell, np.array(lineFilament)
+
+# Time every move of a program
+def estimateGcode(lines):
+    deltas, feeds, moveLimits, dwell, lineFilament = parseMoves(lines)
+    count = len(deltas)
+    if count == 0:
+        return Estimate(np.zeros(0), 0.0, 0.0, dwell, lineFilament)
+
+    maxAccel = np.array([l['maxAccel'] for l in moveLimits])
+    maxFeed = np.array([l['maxFeed'] for l in moveLimits])
+    jerk = np.array([l['jerk'] for l in moveLimits])
+
+    # Move length, E only moves (retractions) are measured along E
+    length = np.linalg.norm(deltas[:, :3], axis=1)
+    eOnly = length < EPSILON
+    length = np.where(eOnly, np.abs(deltas[:, 3]), length)
+    unit = np.abs(deltas) / length[:, None] # share of the move on every axis
+    direction = deltas / length[:, None]
+
+    # Cruise speed, limited by the max feedrate of every axis (moves before the first F run at the max)
+    feeds = np.where(feeds > 0, feeds, np.inf)
+    extruding = (deltas[:, 3] > 0) & ~eOnly
+    minFeed = np.array([l['minFeed'] if e else l['minTravelFeed'] for l, e in zip(moveLimits, extruding)])
+    with np.errstate(divide='ignore'):
+        speed = np.minimum(feeds, np.min(maxFeed / unit, axis=1))
+        accel = np.where(eOnly, [l['retractAccel'] for l in moveLimits],
+                np.where(extruding, [l['printAccel'] for l in moveLimits], [l['travelAccel'] for l in moveLimits]))
+        accel = np.minimum(accel, np.min(maxAccel / unit, axis=1))
+        speed = np.maximum(speed, minFeed)
+
+        # Speed the move can start/stop at from standstill without exceeding the jerk of any axis
+        safe = np.minimum(speed, np.min(jerk / unit, axis=1))
+
+        # Junction speed, the change of every axis' speed at the corner stays within its jerk
+        change = np.abs(direction[1:] - direction[:-1])
+        junction = np.minimum(np.minimum(speed[:-1], speed[1:]), np.min(jerk[1:] / change, axis=1))
+
+    # Entry speed of every move, plus the exit speed of the last one
+    entry = np.concatenate([[safe[0]], np.maximum(junction, 0), [safe[-1]]])
+
+    # Backward pass, every move must be able to slow down to the next entry speed
+    reach = 2*accel*length
+    for i in range(count - 1, -1, -1):
+        entry[i] = min(entry[i], (entry[i + 1]**2 + reach[i])**0.5)
+
+    # Forward pass, and speed up to it
+    for i in range(count):
+        entry[i + 1] = min(entry[i + 1], (entry[i]**2 + reach[i])**0.5)
+
+    return Estimate(trapezoidTimes(entry[:-1], entry[1:], speed, accel, length), float(deltas[:, 3].sum()), float(deltas[extruding, 3].sum()), dwell, lineFilament)
+
+# Time of trapezoid speed profiles, all moves at once
+def trapezoidTimes(v0, v1, speed, accel, length):
+    accelDist = (speed**2 - v0**2) / (2*accel)
+    decelDist = (speed**2 - v1**2) / (2*accel)
+    cruise = length - accelDist - decelDist
+
+    # No room to cruise, the profile is a triangle with a lower peak speed
+    peak = np.where(cruise >= 0, speed, np.sqrt(np.maximum((2*accel*length + v0**2 + v1**2) / 2, 0)))
+    return (peak - v0)/accel + (peak - v1)/accel + np.maximum(cruise, 0)/speed
+
+# Estimate a whole program given as text
+def estimateProgram(gcode):
+    return estimateGcode(gcode.split('\n'))
@@ -1,12 +1,10 @@
 import math
 import datetime
+import numpy as np
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
 
-# Global Vars
-CUR_X = 0
-CUR_Y = 0 
-CUR_Z = 0
-
-RETRACTED = False
+from gcode_gen import toolpath, moves, travel
 
 # Default Settings
 BED_X = 200
@@ -84,6 +82,58 @@ settings = {
     # 'paStep': PA_STEP
 }
 
+# Generation context
+# Holds the toolhead state (position, retraction) for one program, and a read only copy of the
+# settings, so several programs can be generated at the same time without sharing module state
+class GcodeContext: 
+    def __init__(self, modified_settings=None): 
+        merged = dict(settings) # copy of defaults, never modified
+        if modified_settings is not None: 
+            merged.update(modified_settings)
+        self.settings = MappingProxyType(merged)
+
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.retracted = False
+        self.hopped = False # nozzle raised by a z hop, only a retract with z hop enabled raises it
+
+        self.moves = None # list of recorded move arrays, set to [] to record the toolpath IR
+
+    # Record moves into the toolpath IR, if recording
+    def record(self, records): 
+        if self.moves is not None: 
+            self.moves.append(records)
+
+    # Current position in machine coordinates
+    def machineXY(self): 
+        settings = self.settings
+        return (rotateX(self.x, settings['centerX'], self.y, settings['centerY'], settings['printDir']), rotateY(self.x, settings['centerX'], self.y, settings['centerY'], settings['printDir']))
+
+    # Formatting of the values that change between particles, overridden to compile templates
+    def fmtTemp(self, Te): 
+        return str(Te)
+
+    def fmtMoveSpeed(self): 
+        return str(self.settings['moveSpeed'])
+
+    def fmtTime(self): 
+        return formatTime(datetime.datetime.now())
+
+    def fmtExt(self, extRatio, extMult, length): 
+        return str(round(extRatio * extMult * length, 5))
+
+    # Same as above for a whole toolpath at once
+    def fmtMoveSpeeds(self, count): 
+        return [self.fmtMoveSpeed()]*count
+
+    def fmtExts(self, extRatio, extMult, lengths): 
+        return [str(round(e, 5)) for e in (extRatio * extMult * lengths).tolist()]
+
+# Time of the header comment
+def formatTime(x): 
+    return "{}-{}-{} at {}:{}:{}".format(x.year, "0" + str(x.month) if x.month < 10 else x.month, "0" + str(x.day) if x.day<10 else x.day, x.hour, x.minute, x.second)
+
 # Gcode generation
 
 # LINE
@@ -96,63 +146,184 @@ line_length = 100
 # [ ] [ ] [ ]
 # [ ] [ ] [ ]
 square_size = 30
+plane_layers = 4
+cube_size = 20
+cube_height = 20
+cube_perimeters = 2 # perimeters above the first layer
+
+# Height above the printed objects for travels between objects of a bed, mm
+travel_clearance = 1
+# Radius around the nozzle taken by the extruder and fan shroud, cubes are spaced at least this far
+# apart so the shroud clears the cubes printed before, mm
+extruder_clearance = 45
 
 # Cube
 #       [3] 
 #    [2]   [4]
 # [2]         [5]
 
-def gcode_gen(mode, iter, modified_settings): #x, y, indicate the position of the print
+def gcode_gen(mode, iter, modified_settings, ctx=None): #x, y, indicate the position of the print
+    return ''.join(streamGcode(mode, iter, modified_settings, ctx))
 
-    gcode = ''
-    settings.update(modified_settings)
+def streamGcode(mode, iter, modified_settings, ctx=None): 
+
+    if ctx is None: 
+        ctx = GcodeContext(modified_settings)
 
-    # print(settings)
+    # print(ctx.settings)
+
+    # generate line or plane, one object
+    if mode in ('L', 'P', 'C'): 
+        yield "M486 T1\n"
 
-    # generate line or plane
     if mode == 'L': 
-        gcode += genLine(iter, settings)
+        yield from streamLine(iter, ctx)
     elif mode == 'P':
-        gcode += genPlane(iter, settings, square_size)
+        yield from streamPlane(iter, ctx, square_size)
     elif mode == 'C':
-        gcode += genCube(iter, settings, square_size)
+        yield from streamCube(iter, ctx, cube_size)
     else:
         mode = input('Enter L for Line, P for Plane, C for Cube')
-    
-    return gcode
+
+# Several objects (one per iter) on one bed, in the order with the least travel between them
+def genBed(mode, iters, modified_settings, ctx=None): 
+    return ''.join(streamBed(mode, iters, modified_settings, ctx))
+
+def streamBed(mode, iters, modified_settings, ctx=None): 
+
+    if ctx is None: 
+        ctx = GcodeContext(modified_settings)
+    settings = ctx.settings
+
+    if mode == 'L': 
+        starts = [linePosition(i, settings) for i in iters]
+        height = HEIGHT_FIRSTLAYER
+    elif mode == 'P': 
+        starts = [planePosition(i, square_size) for i in iters]
+        height = plane_layers*settings['layerHeight']
+    elif mode == 'C': 
+        starts = [cubePosition(i, cube_size) for i in iters]
+        height = cube_height
+    else: 
+        raise ValueError('Unknown mode {}, expected L, P or C'.format(mode))
+
+    def body(k, ctx): 
+        if mode == 'L': 
+            return streamLineBody(iters[k], ctx, id=k)
+        elif mode == 'P': 
+            return streamPlaneBody(iters[k], ctx, square_size, id=k)
+        elif mode == 'C': 
+            return streamCubeBody(iters[k], ctx, cube_size, id=k)
+
+    # Where every object is left, from a dry run of its body on a throwaway context, so the order
+    # is costed from the end of one object to the start of the next
+    ends = []
+    for k in range(len(iters)): 
+        dry = GcodeContext(modified_settings)
+        dry.x, dry.y, dry.z = starts[k][0], starts[k][1], HEIGHT_FIRSTLAYER
+        for chunk in body(k, dry): 
+            pass
+        ends.append((dry.x, dry.y))
+
+    order = travel.planOrder((ctx.x, ctx.y), starts, ends)
+    yield "M486 T{}\n".format(len(iters)) # number of objects, ids are the index in iters
+    top = 0 # highest object printed so far
+
+    for k in order: 
+        # One hop over everything printed, then straight to the next object
+        travelZ = max(top, HEIGHT_FIRSTLAYER) + travel_clearance
+        if ctx.z < travelZ: 
+            yield moveToZ(travelZ, ctx)
+        yield moveToXY(to_x=starts[k][0], to_y=starts[k][1], ctx=ctx, optional={'comment': ' ; Travel to next object\n'})
+        yield moveToZ(HEIGHT_FIRSTLAYER, ctx)
+        yield from body(k, ctx)
+
+        top = max(top, height)
+
+# Whole program (start, print, end) as a lazy stream of gcode chunks
+def streamProgram(mode, iter, modified_settings, nozzleD, Te, Tb, ctx=None): 
+    if ctx is None: 
+        ctx = GcodeContext(modified_settings) # one context shared by start, print and end
+    yield from streamStart(iter=iter, nozzleD=nozzleD, Te=Te, Tb=Tb, ctx=ctx)
+    yield from streamGcode(mode, iter, modified_settings, ctx)
+    yield from streamEnd(ctx)
+
+# Whole program as a string, top level so it can be run in a worker process
+def genProgram(mode, iter, modified_settings, nozzleD, Te, Tb): 
+    return ''.join(streamProgram(mode, iter, modified_settings, nozzleD, Te, Tb))
+
+# Generate several programs in parallel, jobs are tuples of genProgram arguments
+def genPrograms(jobs, workers=None): 
+    with ProcessPoolExecutor(max_workers=workers) as pool: 
+        return list(pool.map(genProgram, *zip(*jobs)))
+
+# Toolpath IR (moves array) of the print, without start and end gcode
+def genMoves(mode, iter, modified_settings): 
+    ctx = GcodeContext(modified_settings)
+    ctx.moves = []
+    for chunk in streamGcode(mode, iter, modified_settings, ctx): 
+        pass
+    return moves.joinMoves(ctx.moves)
+
+# True if the moves parsed back from the gcode text of the print are its recorded IR
+def checkMoves(mode, iter, modified_settings): 
+    recorded = genMoves(mode, iter, modified_settings)
+    parsed = moves.fromGcode(streamLines(streamGcode(mode, iter, modified_settings, GcodeContext(modified_settings))))
+    return moves.sameMoves(recorded, parsed)
+
+# Split a stream of gcode chunks into single lines (no line endings)
+def streamLines(chunks): 
+    rest = ''
+    for chunk in chunks: 
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        yield from lines
+    if rest: 
+        yield rest
+
+# Write a stream of gcode chunks to a file without building the whole program in memory
+def writeGcode(chunks, filename): 
+    with open(filename, 'w') as f:
+        for chunk in chunks: 
+            f.write(chunk)
 
 # PRUSA SPECIFIC GCODE GENERATION
-def genStart(iter, nozzleD, Te, Tb): 
-    global CUR_X, CUR_Y, CUR_Z
+def genStart(iter, nozzleD, Te, Tb, ctx=None): 
+    return ''.join(streamStart(iter, nozzleD, Te, Tb, ctx))
+
+def streamStart(iter, nozzleD, Te, Tb, ctx=None): 
 
-    x = datetime.datetime.now()
-    gcode = "; generated by PrusaSlicer 2.5.0+win64 on {}-{}-{} at {}:{}:{} UTC \n\n\n".format(x.year, "0" + str(x.month) if x.month < 10 else x.month, "0" + str(x.day) if x.day<10 else x.day, x.hour, x.minute, x.second)
+    if ctx is None: 
+        ctx = GcodeContext()
+    settings = ctx.settings
+
+    yield "; generated by PrusaSlicer 2.5.0+win64 on {} UTC \n\n\n".format(ctx.fmtTime())
     
     # ADD other
-    # gcode += open('./start.txt', 'r').read()
+    # yield open('./start.txt', 'r').read()
 
     # Setting Accelerations etc
-    gcode += "\n\nM73 P0 R0.45 \nM73 Q0 S0.45 \nM201 X1000 Y1000 Z200 E5000 ; sets maximum accelerations, mm/sec^2 \n"
-    gcode += "M203 X200 Y200 Z12 E120 ; sets maximum feedrates, mm / sec\n"
-    gcode += "M204 P1250 R1250 T1250 ; sets acceleration (P, T) and retract acceleration (R), mm/sec^2 \n"
-    gcode += "M205 X8.00 Y8.00 Z0.40 E4.50 ; sets the jerk limits, mm/sec\n"
-    gcode += "M205 S0 T0 ; sets the minimum extruding and travel feed rate, mm/sec \n"
-    gcode += "M107\n"
+    yield "\n\nM73 P0 R0.45 \nM73 Q0 S0.45 \nM201 X1000 Y1000 Z200 E5000 ; sets maximum accelerations, mm/sec^2 \n"
+    yield "M203 X200 Y200 Z12 E120 ; sets maximum feedrates, mm / sec\n"
+    yield "M204 P1250 R1250 T1250 ; sets acceleration (P, T) and retract acceleration (R), mm/sec^2 \n"
+    yield "M205 X8.00 Y8.00 Z0.40 E4.50 ; sets the jerk limits, mm/sec\n"
+    yield "M205 S0 T0 ; sets the minimum extruding and travel feed rate, mm/sec \n"
+    yield "M107\n"
 
     # Basic Settings
-    gcode += ";TYPE:Custom\n"
-    gcode += 'M862.3 P "MK3S" ; printer model check\n'
-    gcode += "M862.1 P{} ; nozzle diameter check\n".format(nozzleD)
-    gcode += "M115 U3.11.0 ; tell printer latest fw version\n"
-    gcode += "G90 ; use absolute coordinates\n"
-    gcode += "M83 ; extruder relative mode\n"
-    gcode += "M104 S{} ; set extruder temp\n".format(Te)
-    gcode += "M140 S{} ; set bed temp\n".format(Tb)
-    # gcode += "M190 S{} ; wait for bed temp\n".format(Tb)
-    gcode += "M109 S{} ; wait for extruder temp\n".format(Te)
-    gcode += "G28 W ; home all without mesh bed level\n"
+    yield ";TYPE:Custom\n"
+    yield 'M862.3 P "MK3S" ; printer model check\n'
+    yield "M862.1 P{} ; nozzle diameter check\n".format(nozzleD)
+    yield "M115 U3.11.0 ; tell printer latest fw version\n"
+    yield "G90 ; use absolute coordinates\n"
+    yield "M83 ; extruder relative mode\n"
+    yield "M104 S{} ; set extruder temp\n".format(ctx.fmtTemp(Te))
+    yield "M140 S{} ; set bed temp\n".format(Tb)
+    # yield "M190 S{} ; wait for bed temp\n".format(Tb)
+    yield "M109 S{} ; wait for extruder temp\n".format(ctx.fmtTemp(Te))
+    yield "G28 W ; home all without mesh bed level\n"
     #if iter == 1: 
-    gcode += "G80 ; mesh bed leveling\n\n"
+    yield "G80 ; mesh bed leveling\n\n"
 
     # Intro line
     intro_length = 20
@@ -167,79 +338,89 @@ def genStart(iter, nozzleD, Te, Tb):
     # ZOffset = (iter-1)*settings['firstLayerHeight']
 
     # if iter == 1: # only on first print -- OLD
-    gcode += "G1 Z{} F720 \nG1 Y{} F1000 \nG92 E0 \nG1 X{} E9 F1000 ; intro line \nG1 X{} E9 F1000 ; intro line\n\n".format(settings['firstLayerHeight'], introY, introX1, introX2)
+    yield "G1 Z{} F720 \nG1 Y{} F1000 \nG92 E0 \nG1 X{} E9 F1000 ; intro line \nG1 X{} E9 F1000 ; intro line\n\n".format(settings['firstLayerHeight'], introY, introX1, introX2)
     # Z-hop to avoid objects
-    gcode += moveToZ(intro_zhop, settings)
+    yield moveToZ(intro_zhop, ctx)
 
     # Level again, set flow, set other
-    gcode += "G92 E0 \nM221 S95\n\n; Don't change E values below. Excessive value can damage the printer.\n\n"
+    yield "G92 E0 \nM221 S95\n\n; Don't change E values below. Excessive value can damage the printer.\n\n"
 
-    gcode += "M907 E538 ; set extruder motor current\n"
-    gcode += "G21 ; set units to millimeters\n"
-    gcode += "G90 ; use absolute coordinates\n"
-    gcode += "M83 ; use relative distances for extrusion\n"
-    gcode += "M900 K0 ; Filament gcode LA 1.5\n"
-    gcode += "M107\n"
+    yield "M907 E538 ; set extruder motor current\n"
+    yield "G21 ; set units to millimeters\n"
+    yield "G90 ; use absolute coordinates\n"
+    yield "M83 ; use relative distances for extrusion\n"
+    yield "M900 K0 ; Filament gcode LA 1.5\n"
+    yield "M107\n"
 
     # Layer Change
-    gcode += ";LAYER_CHANGE\n;Z:0.2\n;HEIGHT:0.2\n;BEFORE_LAYER_CHANGE\nG92 E0.0\n;0.2\n\n\n"
+    yield ";LAYER_CHANGE\n;Z:0.2\n;HEIGHT:0.2\n;BEFORE_LAYER_CHANGE\nG92 E0.0\n;0.2\n\n\n"
 
-    return gcode
+def genEnd(ctx=None): 
+    return ''.join(streamEnd(ctx))
 
-def genEnd(): 
+def streamEnd(ctx=None): 
     # Park and Reset Flow
     # Park Location, in mm
     x = 100
     y = 200
+    z = 9 if ctx is None else max(9, ctx.z + travel_clearance) # never down into a tall print
 
     # Move up and to the middle of the bed
-    gcode = "G1 Z9 F720 ; Move print head up \nG1 X{} Y{} F3600 ; park \nG1 Z57 F720 ; Move print head further up \nG4 ; wait \nM221 S100 ; reset flow\n\n".format(x,y)
+    yield "G1 Z{} F720 ; Move print head up \nG1 X{} Y{} F3600 ; park \nG1 Z57 F720 ; Move print head further up \nG4 ; wait \nM221 S100 ; reset flow\n\n".format(z,x,y)
 
     # Turn Everything Off
-    gcode += "M104 S0 ; turn off temperature\n"
-    gcode += "M140 S0 ; turn off heatbed\n"
-    gcode += "M107 ; turn off fan \nM84 ; disable motors \nM73 P100 R0 \nM73 Q100 S0\n\n"
+    yield "M104 S0 ; turn off temperature\n"
+    yield "M140 S0 ; turn off heatbed\n"
+    yield "M107 ; turn off fan \nM84 ; disable motors \nM73 P100 R0 \nM73 Q100 S0\n\n"
 
-    return gcode
+def genLine(iter, ctx): 
+    return ''.join(streamLine(iter, ctx))
 
-def genLine(iter, settings): 
-    TO_X = iter*15
-    TO_Y = settings['lineSpacing'] + 10
-    TO_Z = HEIGHT_FIRSTLAYER
-    line_length = 100
+# Start of the line for an iteration
+def linePosition(iter, settings): 
+    return (iter*15, settings['lineSpacing'] + 10)
 
-    gcode = ''
+def streamLine(iter, ctx): 
+    TO_X, TO_Y = linePosition(iter, ctx.settings)
+    TO_Z = HEIGHT_FIRSTLAYER
 
     # Printing Z position
-    # gcode += ";AFTER_LAYER_CHANGE\n;0.2\n"
-    gcode += moveToZ(TO_Z, settings)
+    # yield ";AFTER_LAYER_CHANGE\n;0.2\n"
+    yield moveToZ(TO_Z, ctx)
 
     # Initial xy pos
-    gcode += moveToXY(to_x=TO_X, to_y=TO_Y, settings=settings, optional={'comment': ' ; Moving to line position\n'})
+    yield moveToXY(to_x=TO_X, to_y=TO_Y, ctx=ctx, optional={'comment': ' ; Moving to line position\n'})
+
+    yield from streamLineBody(iter, ctx)
+
+# Print the line, starting at its position
+def streamLineBody(iter, ctx, id=0): 
+    TO_X, TO_Y = linePosition(iter, ctx.settings)
+    line_length = 100
     
     # Set Acceleration
-    gcode += "M204 S800\n"
+    yield "M204 S800\n"
 
     # Print line 
-    gcode += "; printing line start id:0 copy 0 \n"
-    gcode += createLine(to_x=TO_X, to_y=line_length, settings=settings, optional={'comment': ' ; Create Line \n'})
-    gcode += "; stop printing line id:0 copy 0\n"
+    yield "; printing line start id:{} copy 0 \n".format(id)
+    yield "M486 S{}\n".format(id) # object label, the object can be cancelled by its id
+    yield createLine(to_x=TO_X, to_y=line_length, ctx=ctx, optional={'comment': ' ; Create Line \n'})
+    yield "M486 S-1\n"
+    yield "; stop printing line id:{} copy 0\n".format(id)
 
     # Force retract
-    gcode += retract()
+    yield retract(ctx)
 
     # Set Progresss
-    # gcode += "M73 P100 R0\nM73 Q100 S0\n"
-
-    gcode += "\n\n"
+    # yield "M73 P100 R0\nM73 Q100 S0\n"
 
-    return gcode
+    yield "\n\n"
 
-def genPlane(iter, settings, size): 
-    global CUR_X, CUR_Y, CUR_Z
+def genPlane(iter, ctx, size): 
+    return ''.join(streamPlane(iter, ctx, size))
 
-    # Variables
-    gcode = ''
+# Corner of the plane for an iteration
+def planePosition(iter, size): 
     initial_gap = 10 #mm
     gap = 10 #mm
     TO_X = initial_gap + (iter-1)*(size + gap) # start from line spacing
@@ -249,58 +430,139 @@ def genPlane(iter, settings, size):
         col_iter = math.floor(total_X/250) # column number for new row
         TO_Y += col_iter*(size+gap) # set Y position
         TO_X = initial_gap + (col_iter - 1)*(size + gap) # Recalculate X position using column number
+    return (TO_X, TO_Y)
+
+def streamPlane(iter, ctx, size): 
+
+    # Variables
+    TO_X, TO_Y = planePosition(iter, size)
     TO_Z = HEIGHT_FIRSTLAYER # set Z position
-    layers = 4 # number of layers
 
     # Start Printing
     # Move Up in Z 
-    gcode += moveToZ(TO_Z + 3, settings) # go up 3mm to avoid collision
+    yield moveToZ(TO_Z + 3, ctx) # go up 3mm to avoid collision
 
     # Initial xy pos
-    gcode += moveToXY(to_x=0, to_y=CUR_Y, settings=settings, optional={'comment': ' ; Moving to plane position\n'})
-    gcode += moveToXY(to_x=CUR_X, to_y=TO_Y-3, settings=settings, optional={'comment': ' ; Moving to plane position\n'})
+    yield moveToXY(to_x=0, to_y=ctx.y, ctx=ctx, optional={'comment': ' ; Moving to plane position\n'})
+    yield moveToXY(to_x=ctx.x, to_y=TO_Y-3, ctx=ctx, optional={'comment': ' ; Moving to plane position\n'})
 
-    # gcode += moveToXY(to_x=CUR_X, to_y=TO_Y - 2, settings=settings, optional={'comment': ' ; Moving to plane position\n'})
-    # gcode += moveToXY(to_x=TO_X, to_y=CUR_Y, settings=settings, optional={'comment': ' ; Moving to plane position\n'})
-    gcode += moveToZ(TO_Z, settings) # go to Z position
+    # yield moveToXY(to_x=ctx.x, to_y=TO_Y - 2, ctx=ctx, optional={'comment': ' ; Moving to plane position\n'})
+    # yield moveToXY(to_x=TO_X, to_y=ctx.y, ctx=ctx, optional={'comment': ' ; Moving to plane position\n'})
+    yield moveToZ(TO_Z, ctx) # go to Z position
+
+    yield from streamPlaneBody(iter, ctx, size)
+
+# Print the plane, starting at its first layer height
+def streamPlaneBody(iter, ctx, size, id=0): 
+    settings = ctx.settings
+    TO_X, TO_Y = planePosition(iter, size)
+    layers = plane_layers # number of layers
 
     # Set Acceleration
-    gcode += "M204 S800\n"
+    yield "M204 S800\n"
 
     # Print plane
-    gcode += "; printing plane start id:0 copy 0 \n"
+    yield "; printing plane start id:{} copy 0 \n".format(id)
+    yield "M486 S{}\n".format(id) # object label, the object can be cancelled by its id
     
     for i in range(0, layers): 
-        gcode += moveToZ((i+1)*settings['layerHeight'], settings) # move to layer height
-        gcode += createBoxTrue(TO_X, TO_Y, size, size, settings, {'fill': True})
-        gcode += retract()
+        yield moveToZ((i+1)*settings['layerHeight'], ctx) # move to layer height
+        yield from streamBoxTrue(TO_X, TO_Y, size, size, ctx, {'fill': True})
+        yield retract(ctx)
 
-    gcode += "; stop printing plane id:0 copy 0\n"
+    yield "M486 S-1\n"
+    yield "; stop printing plane id:{} copy 0\n".format(id)
 
-    return gcode
+def genCube(iter, ctx, size): 
+    return ''.join(streamCube(iter, ctx, size))
 
-def genCube(iter, settings, size): 
-    gcode = ''
-    return gcode
+# Cube on the same grid as the planes, generated one layer at a time so tall cubes can be sent
+# while later layers are still being generated
+# Front left corner of the cube for an iteration, in rows across the bed with extruder_clearance
+# between cubes
+def cubePosition(iter, size): 
+    initial_gap = 10 #mm
+    pitch = size + extruder_clearance
+    columns = math.floor((250 - initial_gap - size)/pitch) + 1 # cubes per row
+    TO_X = initial_gap + ((iter-1) % columns)*pitch
+    TO_Y = initial_gap + ((iter-1) // columns)*pitch
+    if TO_Y + size > 210: 
+        raise ValueError('Cube {} does not fit on the bed, {} cubes fit'.format(iter, columns*(math.floor((210 - initial_gap - size)/pitch) + 1)))
+    return (TO_X, TO_Y)
 
-# ------------------------------------------------------------------------------------------- # 
-def moveToZ(to_z, settings): 
+def streamCube(iter, ctx, size): 
+
+    # Variables
+    TO_X, TO_Y = cubePosition(iter, size)
+    TO_Z = HEIGHT_FIRSTLAYER # set Z position
+
+    # Move up over any cube on the bed and straight to the cube position
+    yield moveToZ(cube_height + travel_clearance, ctx)
+    yield moveToXY(to_x=TO_X, to_y=TO_Y-3, ctx=ctx, optional={'comment': ' ; Moving to cube position\n'})
+    yield moveToZ(TO_Z, ctx) # go to Z position
+
+    yield from streamCubeBody(iter, ctx, size)
+
+# Print the cube, starting at its first layer height
+def streamCubeBody(iter, ctx, size, id=0): 
+    settings = ctx.settings
+    TO_X, TO_Y = cubePosition(iter, size)
+    layers = cubeLayers(settings)
+
+    # Set Acceleration
+    yield "M204 S800\n"
+
+    yield "; printing cube start id:{} copy 0 \n".format(id)
+    yield "M486 S{}\n".format(id) # object label, the object can be cancelled by its id
+
+    for i in range(0, layers): 
+        yield from streamCubeLayer(i, TO_X, TO_Y, size, ctx)
 
-    global CUR_Z
+    yield "M486 S-1\n"
+    yield "; stop printing cube id:{} copy 0\n".format(id)
+
+def cubeLayers(settings): 
+    return 1 + round((cube_height - settings['firstLayerHeight']) / settings['layerHeight'])
+
+# One solid layer, the first layer uses the anchor settings like the plane
+def streamCubeLayer(i, x, y, size, ctx): 
+    settings = ctx.settings
+
+    if i == 0: 
+        z = settings['firstLayerHeight']
+        optional = {'fill': True}
+    else: 
+        z = settings['firstLayerHeight'] + i*settings['layerHeight']
+        optional = {
+            'fill': True,
+            'num_perims': cube_perimeters,
+            'spacing': settings['lineSpacing'],
+            'extRatio': settings['extRatio'],
+        }
+
+    yield ";LAYER_CHANGE\n;Z:{}\n".format(round(z, settings['zRound']))
+    yield moveToZ(z, ctx) # move to layer height
+    yield from streamBoxTrue(x, y, size, size, ctx, optional)
+    yield retract(ctx)
+
+# ------------------------------------------------------------------------------------------- # 
+def moveToZ(to_z, ctx): 
+    settings = ctx.settings
 
     gcode = ''
     gcode += 'G0 Z' + str(round(to_z, 3)) + ' F' + str(settings['zSpeed']) + ' ; Move to z height\n'
-    CUR_Z = to_z # Update global position
+    ctx.z = to_z # Update context position
+    ctx.hopped = False
+    ctx.record(moves.makeMoves(*ctx.machineXY(), to_z, 0, settings['zSpeed'], moves.ZMOVE))
 
     return gcode
 
 
-def moveToXY(to_x, to_y, settings, optional): 
-
-    global CUR_X, CUR_Y
+def moveToXY(to_x, to_y, ctx, optional): 
+    settings = ctx.settings
 
     gcode = ''
-    distance = getDistance(CUR_X, CUR_Y, to_x, to_y)
+    distance = getDistance(ctx.x, ctx.y, to_x, to_y)
 
     defaults = {
       'comment': ' ; Move\n'
@@ -311,15 +573,16 @@ def moveToXY(to_x, to_y, settings, optional):
     optArgs.update(optional)
 
     if distance > 2: # don't retract for travels under 2mm
-        gcode += doEfeed('-', settings) #retract
+        gcode += doEfeed('-', ctx) #retract
 
-    gcode += 'G0 X' + str(round(rotateX(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), settings['xyRound'])) + ' Y' + str(round(rotateY(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), settings['xyRound'])) +' F' + str(settings['moveSpeed']) + optArgs['comment']
+    gcode += 'G0 X' + str(round(rotateX(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), settings['xyRound'])) + ' Y' + str(round(rotateY(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), settings['xyRound'])) +' F' + ctx.fmtMoveSpeed() + optArgs['comment']
   
-    CUR_X = to_x # update global position vars
-    CUR_Y = to_y
+    ctx.x = to_x # update context position vars
+    ctx.y = to_y
+    ctx.record(moves.makeMoves(*ctx.machineXY(), ctx.z + (settings['zhopHeight'] if ctx.hopped else 0), 0, settings['moveSpeed'], moves.TRAVEL))
 
     if distance >= 2: 
-        gcode += doEfeed('+', settings)  #un-retract
+        gcode += doEfeed('+', ctx)  #un-retract
 
     return gcode
 
@@ -351,41 +614,45 @@ def getDistance(cur_x, cur_y, to_x, to_y):
   return math.hypot((to_x - cur_x), (to_y - cur_y))
 
 # extruder feed gcode
-def doEfeed(dir, settings): 
-    global RETRACTED, CUR_Z, Z_ROUND
-
-    gcode = ''
-
-    if dir == '+' and RETRACTED and not settings['zhopEnable']:
-        gcode += 'G1 E' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['unretractSpeed']) + ' ; Un-retract\n'
-        RETRACTED = False
-        return gcode
-    elif dir == '-' and not RETRACTED and not settings['zhopEnable']:
-        gcode += 'G1 E-' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['retractSpeed']) + ' ; Retract\n'
-        RETRACTED = True
-        return gcode
-    elif dir == '+' and RETRACTED and settings['zhopEnable']:
-        gcode += 'G1 Z' + str(round(CUR_Z, Z_ROUND)) + ' F' + str(settings['zSpeed']) + ' ; Z hop return\n' + 'G1 E' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['unretractSpeed']) + ' ; Un-retract\n'
-        RETRACTED = False
-        return gcode
-    elif dir == '-' and not RETRACTED and settings['zhopEnable']:
-        gcode += 'G1 E-' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['retractSpeed']) + ' ; Retract\n' + 'G1 Z' + str(round((CUR_Z + settings['zhopHeight']), settings['zRound'])) + ' F' + str(settings['zSpeed']) + ' ; Z hop\n'
-        RETRACTED = True
-        return gcode
-    return gcode
+def doEfeed(dir, ctx): 
+
+    if dir == '+' and ctx.retracted:
+        ctx.retracted = False
+        ctx.hopped = False
+        ctx.record(moves.efeedMoves('+', *ctx.machineXY(), ctx.z, ctx.settings))
+        return efeedText('+', ctx)
+    elif dir == '-' and not ctx.retracted:
+        ctx.retracted = True
+        ctx.hopped = ctx.settings['zhopEnable']
+        ctx.record(moves.efeedMoves('-', *ctx.machineXY(), ctx.z, ctx.settings))
+        return efeedText('-', ctx)
+    return ''
+
+# un-retract (+) or retract (-) gcode, with z hop if enabled
+def efeedText(dir, ctx): 
+    settings = ctx.settings
+
+    if dir == '+' and not settings['zhopEnable']:
+        return 'G1 E' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['unretractSpeed']) + ' ; Un-retract\n'
+    elif dir == '-' and not settings['zhopEnable']:
+        return 'G1 E-' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['retractSpeed']) + ' ; Retract\n'
+    elif dir == '+' and settings['zhopEnable']:
+        return 'G1 Z' + str(round(ctx.z, Z_ROUND)) + ' F' + str(settings['zSpeed']) + ' ; Z hop return\n' + 'G1 E' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['unretractSpeed']) + ' ; Un-retract\n'
+    elif dir == '-' and settings['zhopEnable']:
+        return 'G1 E-' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['retractSpeed']) + ' ; Retract\n' + 'G1 Z' + str(round((ctx.z + settings['zhopHeight']), settings['zRound'])) + ' F' + str(settings['zSpeed']) + ' ; Z hop\n'
 
-def retract(): 
-    global RETRACTED
+def retract(ctx): 
+    settings = ctx.settings
 
-    if not RETRACTED: 
-        RETRACTED = True
+    if not ctx.retracted: 
+        ctx.retracted = True
+        ctx.record(moves.makeMoves(*ctx.machineXY(), ctx.z, -settings['retractDist'], settings['retractSpeed'], moves.RETRACT))
         return 'G1 E-' + str(round(settings['retractDist'], 5)) + ' F' + str(settings['retractSpeed']) + ' ; Retract\n'
     else: 
         return ''
 
-def createLine(to_x, to_y, settings, optional): 
-
-    global CUR_X, CUR_Y
+def createLine(to_x, to_y, ctx, optional): 
+    settings = ctx.settings
 
     # handle optional function arguments passed as object
     defaults = {
@@ -400,32 +667,97 @@ def createLine(to_x, to_y, settings, optional):
     optArgs.update(optional)
 
     # change speed if first layer
-    if round(CUR_Z, 3) == settings['firstLayerHeight']: 
+    if round(ctx.z, 3) == settings['firstLayerHeight']: 
         optArgs['speed'] = settings['firstLayerSpeed']
     else: 
         optArgs['speed'] = settings['perimSpeed']
 
-    length = getDistance(CUR_X, CUR_Y, to_x, to_y)
-    ext = round(optArgs['extRatio'] * optArgs['extMult'] * abs(length), 5)
+    length = getDistance(ctx.x, ctx.y, to_x, to_y)
+    ext = ctx.fmtExt(optArgs['extRatio'], optArgs['extMult'], abs(length))
     # print(optArgs['extMult'])
     # print(abs(length))
     # print(ext)
-    gcode = 'G1 X' + str(round(rotateX(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), 4)) + ' Y' + str(round(rotateY(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), 4)) + ' E' + str(ext) + ' F' + str(optArgs['speed']) + optArgs['comment']
+    gcode = 'G1 X' + str(round(rotateX(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), 4)) + ' Y' + str(round(rotateY(to_x, settings['centerX'], to_y, settings['centerY'], settings['printDir']), 4)) + ' E' + ext + ' F' + str(optArgs['speed']) + optArgs['comment']
 
-    CUR_X = to_x # update global position vars
-    CUR_Y = to_y
+    ctx.x = to_x # update context position vars
+    ctx.y = to_y
+    ctx.record(moves.makeMoves(*ctx.machineXY(), ctx.z, optArgs['extRatio'] * optArgs['extMult'] * abs(length), optArgs['speed'], moves.EXTRUDE))
 
     return gcode
 
-# Create Box
-def createBox(min_x, min_y, size_x, size_y, basicSettings, optional):
-    global CUR_X, CUR_Y, CUR_Z, RETRACTED
+# Emit a toolpath from the toolpath engine, starting at the context position
+# Same gcode as moveToXY for travels and createLine for printed moves, formatted in bulk
+def streamPath(xs, ys, printing, comments, ctx, extRatio): 
+    settings = ctx.settings
 
-    gcode = ""
-    x = min_x
-    y = min_y
-    max_x = min_x + size_x
-    max_y = min_y + size_y
+    if len(xs) == 0: 
+        return
+
+    lengths = toolpath.moveLengths(ctx.x, ctx.y, xs, ys)
+    retracts, unretracts, retracted = toolpath.travelRetracts(lengths, printing, ctx.retracted)
+
+    a = settings['printDir'] * math.degrees(math.pi/180) # same conversion as rotateX/rotateY
+    xr, yr = toolpath.rotate(xs, ys, settings['centerX'], settings['centerY'], a)
+
+    # change speed if first layer
+    if round(ctx.z, 3) == settings['firstLayerHeight']: 
+        speed = str(settings['firstLayerSpeed'])
+    else: 
+        speed = str(settings['perimSpeed'])
+
+    travel = ~printing
+    travelX = toolpath.formatRounded(xr[travel], settings['xyRound'])
+    travelY = toolpath.formatRounded(yr[travel], settings['xyRound'])
+    travelF = ctx.fmtMoveSpeeds(len(travelX))
+    printX = toolpath.formatRounded(xr[printing], 4)
+    printY = toolpath.formatRounded(yr[printing], 4)
+    printE = ctx.fmtExts(extRatio, settings['extMult'], lengths[printing])
+
+    gcode = np.empty(len(xs), dtype=object)
+    gcode[travel] = ['G0 X' + x + ' Y' + y + ' F' + f + c for x, y, f, c in zip(travelX, travelY, travelF, comments[travel])]
+    gcode[printing] = ['G1 X' + x + ' Y' + y + ' E' + e + ' F' + speed + c for x, y, e, c in zip(printX, printY, printE, comments[printing])]
+    gcode[retracts] = efeedText('-', ctx) + gcode[retracts]
+    gcode[unretracts] = gcode[unretracts] + efeedText('+', ctx)
+
+    hopped = toolpath.hoppedMoves(retracts, unretracts, ctx.hopped) if settings['zhopEnable'] else np.zeros(len(xs), dtype=bool)
+    if ctx.moves is not None: 
+        ctx.record(pathMoves(xr, yr, printing, lengths, retracts, unretracts, hopped, float(speed), extRatio, ctx))
+
+    ctx.x = float(xs[-1]) # update context position vars
+    ctx.y = float(ys[-1])
+    ctx.retracted = retracted
+    ctx.hopped = bool(hopped[-1] and not unretracts[-1])
+
+    yield ''.join(gcode)
+
+# Toolpath IR of a path, every move expands to: retract, z hop, move, z hop return, un-retract
+# hopped tells which moves run at the z hop height
+def pathMoves(xr, yr, printing, lengths, retracts, unretracts, hopped, speed, extRatio, ctx): 
+    settings = ctx.settings
+    hop = settings['zhopEnable']
+
+    lastX, lastY = ctx.machineXY()
+    prevX = np.concatenate([[lastX], xr[:-1]]) # retract happens before moving
+    prevY = np.concatenate([[lastY], yr[:-1]])
+    hopZ = ctx.z + settings['zhopHeight']
+
+    retract = moves.makeMoves(prevX, prevY, ctx.z, -settings['retractDist'], settings['retractSpeed'], moves.RETRACT)
+    zhop = moves.makeMoves(prevX, prevY, hopZ, 0, settings['zSpeed'], moves.ZMOVE)
+    move = moves.makeMoves(xr, yr, np.where(hopped, hopZ, ctx.z), np.where(printing, extRatio * settings['extMult'] * lengths, 0),
+                           np.where(printing, speed, settings['moveSpeed']), np.where(printing, moves.EXTRUDE, moves.TRAVEL))
+    zreturn = moves.makeMoves(xr, yr, ctx.z, 0, settings['zSpeed'], moves.ZMOVE)
+    unretract = moves.makeMoves(xr, yr, ctx.z, settings['retractDist'], settings['unretractSpeed'], moves.UNRETRACT)
+
+    grid = np.stack([retract, zhop, move, zreturn, unretract], axis=1)
+    keep = np.stack([retracts, retracts & hop, np.ones(len(xr), dtype=bool), unretracts & hop, unretracts], axis=1)
+    return grid[keep]
+
+PERIMETER_COMMENTS = np.array([" ; Step inwards to print next perimeter\n", " ; Draw perimeter (up)\n", " ; Draw perimeter (right)\n", " ; Draw perimeter (down)\n", " ; Draw perimeter (down)\n"])
+FILL_COMMENTS = np.array([" ; Move\n", " ; Fill\n"])
+
+# Perimeters and 45 degree infill of a box, (x0, y0) is the first perimeter corner, (max_x, max_y) the far corner
+def streamBoxPath(min_x, min_y, x0, y0, max_x, max_y, size_x, size_y, ctx, optional):
+    basicSettings = ctx.settings
 
     # handle optional function arguments passed as object
     defaults = {
@@ -450,28 +782,12 @@ def createBox(min_x, min_y, size_x, size_y, basicSettings, optional):
 
     optArgs["num_perims"] = min(optArgs["num_perims"], max_perims)
 
-    if min_x != CUR_X or min_y != CUR_Y:
-        gcode += moveToXY(min_x, min_y, basicSettings, {"comment": " ; Move to box start\n"})
-
-    for i in range(optArgs["num_perims"]):
-        if i != 0:  # after first perimeter, step inwards to start next perimeter
-            x += optArgs["spacing"]
-            y += optArgs["spacing"]
-            gcode += moveToXY(x, y, basicSettings, {"comment": " ; Step inwards to print next perimeter\n"})
-        # draw line up
-        y += size_y - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (up)\n"})
-        # draw line right
-        x += size_x - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (right)\n"})
-        # draw line down
-        y -= size_y - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (down)\n"})
-        # draw line left
-        x -= size_x - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (down)\n"})
-
-        # print('Draw Box')
+    if min_x != ctx.x or min_y != ctx.y:
+        yield moveToXY(min_x, min_y, ctx, {"comment": " ; Move to box start\n"})
+
+    # All perimeters
+    xs, ys, printing, sides = toolpath.boxPerimeters(x0, y0, size_x, size_y, optArgs["spacing"], optArgs["num_perims"])
+    yield from streamPath(xs, ys, printing, PERIMETER_COMMENTS[sides], ctx, optArgs['extRatio'])
 
     if optArgs['fill']:
         spacing_45 = optArgs['spacing'] / math.sin(math.radians(45))
@@ -482,236 +798,32 @@ def createBox(min_x, min_y, size_x, size_y, basicSettings, optional):
         yMaxBound = max_y - (optArgs['spacing'] * (optArgs['num_perims'] - 1) + optArgs['spacing'] * encroachment)
         xCount = math.floor((xMaxBound - xMinBound) / spacing_45)
         yCount = math.floor((yMaxBound - yMinBound) / spacing_45)
-        xRemainder = (xMaxBound - xMinBound) % spacing_45
-        yRemainder = (yMaxBound - yMinBound) % spacing_45
-
-        x = xMinBound
-        y = yMinBound
-        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'],  'comment': ' ; Move to fill start\n'}) # move to start
-
-        for i in range(yCount + xCount):
-            if i < min(yCount, xCount):
-                if i % 2 == 0:
-                    x += spacing_45
-                    y = yMinBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                    y += (x - xMinBound)
-                    x = xMinBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                else:
-                    y += spacing_45
-                    x = xMinBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                    x += (y - yMinBound)
-                    y = yMinBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right
-            elif i < max(xCount, yCount):
-                if xCount > yCount: # if box is wider than tall
-                    if i % 2 == 0:
-                        x += spacing_45
-                        y = yMinBound
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                        x -= yMaxBound - yMinBound
-                        y = yMaxBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                    else:
-                        if i == yCount:
-                            x += (spacing_45 - yRemainder)
-                        else:
-                            x += spacing_45
-                        y = yMaxBound
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                        x += yMaxBound - yMinBound
-                        y = yMinBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right
-                else: # if box is taller than wide
-                    if i % 2 == 0:
-                        x = xMaxBound
-                        if i == xCount:
-                            y += (spacing_45 - xRemainder)
-                        else:
-                            y += spacing_45
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                        x = xMinBound
-                        y += xMaxBound - xMinBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                    else:
-                        x = xMinBound
-                        y += spacing_45
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                        x = xMaxBound
-                        y -= xMaxBound - xMinBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right
-            else: 
-                if i % 2 == 0:
-                    if i == max(xCount, yCount):
-                        y += (spacing_45 - xRemainder)
-                    else:
-                        y += spacing_45
-                    x = xMaxBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                    x -= (yMaxBound - y)
-                    y = yMaxBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                else:
-                    if i == max(xCount, yCount):
-                        x += (spacing_45 - yRemainder)
-                    else:
-                        x += spacing_45
-                    y = yMaxBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                    y -= (xMaxBound - x)
-                    x = xMaxBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right                     
-    return gcode
-
-# Create Box with correct dimensions
-def createBoxTrue(min_x, min_y, size_x, size_y, basicSettings, optional):
-    global CUR_X, CUR_Y, CUR_Z, RETRACTED
-
-    gcode = ""
-    x = min_x - basicSettings['lineWidth']/2
-    y = min_y - basicSettings['lineWidth']/2
-    max_x = min_x + size_x - basicSettings['lineWidth']/2
-    max_y = min_y + size_y - basicSettings['lineWidth']/2
-
-    # handle optional function arguments passed as object
-    defaults = {
-        "fill": False,
-        "num_perims": basicSettings["anchorPerimeters"],
-        "spacing": basicSettings["anchorLineSpacing"],
-        "extRatio": basicSettings["anchorExtRatio"],
-        "speed": basicSettings["firstLayerSpeed"],
-    }
 
-    optArgs = dict()
-    optArgs.update(defaults)
-    if optional is not None:
-        optArgs.update(optional)
+        yield moveToXY(xMinBound, yMinBound, ctx, {'comment': ' ; Move to fill start\n'}) # move to start
 
-    max_perims = min(
-        math.floor((size_x * math.sin(math.radians(45))) / (optArgs["spacing"] / math.sin(math.radians(45)))),
-        math.floor((size_y * math.sin(math.radians(45))) / (optArgs["spacing"] / math.sin(math.radians(45))))
-    )
-
-    # print('Max Perims: {}'.format(max_perims))
+        # All infill lines
+        xs, ys, printing = toolpath.boxInfill(xMinBound, yMinBound, xMaxBound, yMaxBound, spacing_45, xCount + yCount)
+        yield from streamPath(xs, ys, printing, FILL_COMMENTS[printing.astype(int)], ctx, optArgs['extRatio'])
 
-    optArgs["num_perims"] = min(optArgs["num_perims"], max_perims)
+# Create Box
+def createBox(min_x, min_y, size_x, size_y, ctx, optional):
+    return ''.join(streamBox(min_x, min_y, size_x, size_y, ctx, optional))
 
-    if min_x != CUR_X or min_y != CUR_Y:
-        gcode += moveToXY(min_x, min_y, basicSettings, {"comment": " ; Move to box start\n"})
-
-    for i in range(optArgs["num_perims"]):
-        if i != 0:  # after first perimeter, step inwards to start next perimeter
-            x += optArgs["spacing"]
-            y += optArgs["spacing"]
-            gcode += moveToXY(x, y, basicSettings, {"comment": " ; Step inwards to print next perimeter\n"})
-        # draw line up
-        y += size_y - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (up)\n"})
-        # draw line right
-        x += size_x - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (right)\n"})
-        # draw line down
-        y -= size_y - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (down)\n"})
-        # draw line left
-        x -= size_x - (i * optArgs["spacing"]) * 2
-        gcode += createLine(x, y, basicSettings, {"speed": optArgs["speed"], "extRatio": optArgs["extRatio"], "comment": " ; Draw perimeter (down)\n"})
-
-        # print('Draw Box')
+def streamBox(min_x, min_y, size_x, size_y, ctx, optional):
+    max_x = min_x + size_x
+    max_y = min_y + size_y
+    yield from streamBoxPath(min_x, min_y, min_x, min_y, max_x, max_y, size_x, size_y, ctx, optional)
 
-    if optArgs['fill']:
-        spacing_45 = optArgs['spacing'] / math.sin(math.radians(45))
-        encroachment = 0.25
-        xMinBound = min_x + (optArgs['spacing'] * (optArgs['num_perims'] - 1) + optArgs['spacing'] * encroachment)
-        xMaxBound = max_x - (optArgs['spacing'] * (optArgs['num_perims'] - 1) + optArgs['spacing'] * encroachment)
-        yMinBound = min_y + (optArgs['spacing'] * (optArgs['num_perims'] - 1) + optArgs['spacing'] * encroachment)
-        yMaxBound = max_y - (optArgs['spacing'] * (optArgs['num_perims'] - 1) + optArgs['spacing'] * encroachment)
-        xCount = math.floor((xMaxBound - xMinBound) / spacing_45)
-        yCount = math.floor((yMaxBound - yMinBound) / spacing_45)
-        xRemainder = (xMaxBound - xMinBound) % spacing_45
-        yRemainder = (yMaxBound - yMinBound) % spacing_45
-
-        x = xMinBound
-        y = yMinBound
-        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'],  'comment': ' ; Move to fill start\n'}) # move to start
-
-        for i in range(yCount + xCount):
-            if i < min(yCount, xCount):
-                if i % 2 == 0:
-                    x += spacing_45
-                    y = yMinBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                    y += (x - xMinBound)
-                    x = xMinBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                else:
-                    y += spacing_45
-                    x = xMinBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                    x += (y - yMinBound)
-                    y = yMinBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right
-            elif i < max(xCount, yCount):
-                if xCount > yCount: # if box is wider than tall
-                    if i % 2 == 0:
-                        x += spacing_45
-                        y = yMinBound
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                        x -= yMaxBound - yMinBound
-                        y = yMaxBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                    else:
-                        if i == yCount:
-                            x += (spacing_45 - yRemainder)
-                        else:
-                            x += spacing_45
-                        y = yMaxBound
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                        x += yMaxBound - yMinBound
-                        y = yMinBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right
-                else: # if box is taller than wide
-                    if i % 2 == 0:
-                        x = xMaxBound
-                        if i == xCount:
-                            y += (spacing_45 - xRemainder)
-                        else:
-                            y += spacing_45
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                        x = xMinBound
-                        y += xMaxBound - xMinBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                    else:
-                        x = xMinBound
-                        y += spacing_45
-                        gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                        x = xMaxBound
-                        y -= xMaxBound - xMinBound
-                        gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right
-            else: 
-                if i % 2 == 0:
-                    if i == max(xCount, yCount):
-                        y += (spacing_45 - xRemainder)
-                    else:
-                        y += spacing_45
-                    x = xMaxBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step up
-                    x -= (yMaxBound - y)
-                    y = yMaxBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print up/left
-                else:
-                    if i == max(xCount, yCount):
-                        x += (spacing_45 - yRemainder)
-                    else:
-                        x += spacing_45
-                    y = yMaxBound
-                    gcode += moveToXY(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio']}) # step right
-                    y -= (xMaxBound - x)
-                    x = xMaxBound
-                    gcode += createLine(x, y, basicSettings, {'speed': optArgs['speed'], 'extRatio': optArgs['extRatio'], 'comment': ' ; Fill\n'}) # print down/right                     
-    return gcode
+# Create Box with correct dimensions
+def createBoxTrue(min_x, min_y, size_x, size_y, ctx, optional):
+    return ''.join(streamBoxTrue(min_x, min_y, size_x, size_y, ctx, optional))
+
+def streamBoxTrue(min_x, min_y, size_x, size_y, ctx, optional):
+    x = min_x - ctx.settings['lineWidth']/2
+    y = min_y - ctx.settings['lineWidth']/2
+    max_x = min_x + size_x - ctx.settings['lineWidth']/2
+    max_y = min_y + size_y - ctx.settings['lineWidth']/2
+    yield from streamBoxPath(min_x, min_y, x, y, max_x, max_y, size_x, size_y, ctx, optional)
 
 # with open("test.gcode", "w") as f:
 #     iter = 1
@@ -0,0 +1,160 @@
+import re
+import struct
+import zlib
+import numpy as np
+
+# Toolpath IR
+# Moves are kept in a structured array in machine coordinates (after the print direction rotation),
+# so the geometry can be reused (CV regions, time estimates) before any text gcode is written.
+MOVE = np.dtype([('x', 'f8'), ('y', 'f8'), ('z', 'f8'), ('e', 'f8'), ('f', 'f8'), ('flags', 'u1')])
+
+# Move flags
+TRAVEL = 1
+EXTRUDE = 2
+RETRACT = 4
+UNRETRACT = 8
+ZMOVE = 16
+
+# Binary file layout: header, then zlib compressed float32 records
+BINARY_MAGIC = b'SPGC'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHI') # magic, version, number of moves
+BINARY_MOVE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('e', '<f4'), ('f', '<f4'), ('flags', 'u1')])
+
+# Build moves from scalars or arrays, broadcast to the same length
+def makeMoves(x, y, z, e, f, flags):
+    x, y, z, e, f, flags = np.broadcast_arrays(x, y, z, e, f, flags)
+    moves = np.empty(x.shape, dtype=MOVE)
+    moves['x'] = x
+    moves['y'] = y
+    moves['z'] = z
+    moves['e'] = e
+    moves['f'] = f
+    moves['flags'] = flags
+    return np.atleast_1d(moves)
+
+# Retract (-) or un-retract (+) at (x, y, z), with z hop if enabled, same as doEfeed
+def efeedMoves(dir, x, y, z, settings):
+    retract = makeMoves(x, y, z, -settings['retractDist'], settings['retractSpeed'], RETRACT)
+    unretract = makeMoves(x, y, z, settings['retractDist'], settings['unretractSpeed'], UNRETRACT)
+
+    if not settings['zhopEnable']:
+        return retract if dir == '-' else unretract
+
+    if dir == '-':
+        hop = makeMoves(x, y, z + settings['zhopHeight'], 0, settings['zSpeed'], ZMOVE)
+        return np.concatenate([retract, hop])
+    else:
+        hop = makeMoves(x, y, z, 0, settings['zSpeed'], ZMOVE)
+        return np.concatenate([hop, unretract])
+
+# Join recorded moves into one array
+def joinMoves(records):
+    if not records:
+        return np.empty(0, dtype=MOVE)
+    return np.concatenate(records)
+
+# SERIALIZERS
+
+# Text gcode for the moves, one line per move (relative E, absolute XYZ)
+def toGcode(moves, xyRound=4, zRound=3):
+    x = [str(round(v, xyRound)) for v in moves['x'].tolist()]
+    y = [str(round(v, xyRound)) for v in moves['y'].tolist()]
+    z = [str(round(v, zRound)) for v in moves['z'].tolist()]
+    e = [str(round(v, 5)) for v in moves['e'].tolist()]
+    f = [str(round(v)) for v in moves['f'].tolist()]
+
+    for i, flags in enumerate(moves['flags'].tolist()):
+        if flags & (RETRACT | UNRETRACT):
+            yield 'G1 E' + e[i] + ' F' + f[i]
+        elif flags & ZMOVE:
+            yield 'G0 Z' + z[i] + ' F' + f[i]
+        elif flags & EXTRUDE:
+            yield 'G1 X' + x[i] + ' Y' + y[i] + ' E' + e[i] + ' F' + f[i]
+        else:
+            yield 'G0 X' + x[i] + ' Y' + y[i] + ' F' + f[i]
+
+WORD = re.compile(r'([XYZEF])(-?[\d.]+)')
+
+# Same moves up to the rounding of the text serializer
+def sameMoves(a, b, tolerance=1e-3):
+    if len(a) != len(b) or not np.array_equal(a['flags'], b['flags']):
+        return False
+    return all(np.allclose(a[field], b[field], atol=tolerance) for field in ('x', 'y', 'z', 'e')) and np.allclose(a['f'], b['f'], atol=0.5)
+
+# Parse the moves of a gcode program (G0/G1 only), assumes absolute XYZ and relative E like genStart
+def fromGcode(lines):
+    records = []
+    x = y = z = 0.0
+    f = 0.0
+
+    for line in lines:
+        line = line.split(';', 1)[0].strip()
+        if not line.startswith(('G0', 'G1')) or line[2:3].isdigit():
+            continue
+
+        words = dict((k, float(v)) for k, v in WORD.findall(line))
+        last = (x, y, z)
+        x = words.get('X', x)
+        y = words.get('Y', y)
+        z = words.get('Z', z)
+        e = words.get('E', 0.0)
+        f = words.get('F', f)
+
+        if 'X' in words or 'Y' in words:
+            flags = EXTRUDE if e > 0 else TRAVEL
+        elif 'Z' in words:
+            flags = ZMOVE
+        elif e < 0:
+            flags = RETRACT
+        elif e > 0:
+            flags = UNRETRACT
+        else:
+            continue # feedrate only
+
+        records.append((x, y, z, e, f, flags))
+
+    return np.array(records, dtype=MOVE)
+
+def writeBinary(moves, filename):
+    with open(filename, 'wb') as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(moves)))
+        f.write(zlib.compress(moves.astype(BINARY_MOVE).tobytes(), 9))
+
+def readBinary(filename):
+    with open(filename, 'rb') as f:
+        magic, version, count = BINARY_HEADER.unpack(f.read(BINARY_HEADER.size))
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError('Not a toolpath file: {}'.format(filename))
+        data = zlib.decompress(f.read())
+
+    return np.frombuffer(data, dtype=BINARY_MOVE, count=count).astype(MOVE)
+
+# GEOMETRY
+
+# Bed area covered by printed moves (xmin, ymin, xmax, ymax), None if nothing is printed
+# Used to find the region of interest of a print in the camera image
+def printBounds(moves):
+    printed = (moves['flags'] & EXTRUDE) > 0
+    if not printed.any():
+        return None
+
+    # a printed move starts where the previous move ended
+    starts = np.roll(printed, -1)
+    points = moves[printed | starts]
+    return (float(points['x'].min()), float(points['y'].min()), float(points['x'].max()), float(points['y'].max()))
+
+# Total filament pushed, retractions included
+def filamentLength(moves):
+    return moves['e'].sum()
+
+# Check the text round trip of every mode with and without z hop
+# Run from software/ as python -m gcode_gen.moves
+def main(iters=10):
+    from gcode_gen.generate import checkMoves
+    failed = [(mode, iter, zhop) for mode in 'LPC' for iter in range(1, iters + 1) for zhop in (False, True) if not checkMoves(mode, iter, {'zhopEnable': zhop})]
+    print('IR round trip: {} of {} prints differ {}'.format(len(failed), 3*iters*2, failed if failed else ''))
+    return not failed
+
+if __name__ == '__main__':
+    main()
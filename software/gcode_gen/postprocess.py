@@ -0,0 +1,202 @@
+import re
+
+# Gcode Post Processing
+# Optional pass run on a finished program before sending it. Cuts the bytes that go over the serial
+# link and the number of short segments the planner has to chew through:
+# - comments and blank lines are stripped
+# - modal words are dropped (F equal to the current feedrate, X/Y/Z equal to the current position)
+# - moves that go nowhere are removed, back to back Z moves are folded into one
+# - a retract directly followed by its un-retract is removed
+# - collinear segments with the same feedrate and extrusion per mm are merged
+# Assumes absolute XYZ and relative E (G90, M83) like genStart, other modes are passed through as is.
+
+WORD = re.compile(r'([A-Z])(-?[\d.]+)')
+AXES = ('X', 'Y', 'Z')
+EPSILON = 1e-6 # position tolerance, mm
+COLLINEAR = 1e-3 # max distance from the merged line, mm
+FLOW_TOLERANCE = 1e-3 # relative difference in extrusion per mm allowed when merging
+WINDOW = 3 # longest chain of in place moves that can cancel out: retract, z hop, z return
+
+# A parsed G0/G1 move, start and end are full (x, y, z) positions
+class Move:
+    def __init__(self, cmd, words, start, end):
+        self.cmd = cmd
+        self.words = words # original number strings, so unchanged values print exactly as generated
+        self.start = start
+        self.end = end
+        self.e = float(words['E']) if 'E' in words else 0.0
+        self.f = float(words['F']) if 'F' in words else None
+
+    def moved(self):
+        return any(abs(a - b) > EPSILON for a, b in zip(self.start, self.end))
+
+    def movedXY(self):
+        return any(abs(a - b) > EPSILON for a, b in zip(self.start[:2], self.end[:2]))
+
+    def length(self):
+        return ((self.end[0] - self.start[0])**2 + (self.end[1] - self.start[1])**2)**0.5
+
+    # Only changes the feedrate
+    def feedOnly(self):
+        return not self.moved() and self.e == 0
+
+def optimizeGcode(lines, stripComments=True, dropModal=True, removeNoops=True, foldRetracts=True, mergeCollinear=True):
+    pos = [0.0, 0.0, 0.0]
+    known = [False, False, False] # an axis is unknown at the start and after homing/leveling, until a move sets it
+    absolute = True
+    relativeE = False
+    feed = None # feedrate the printer is using
+    pending = [] # moves held back in case the next move cancels or extends them
+
+    def emit(move):
+        nonlocal feed
+
+        words = [axis + move.words[axis] for axis in AXES + ('E',) if axis in move.words]
+        if move.f is not None and (not dropModal or move.f != feed):
+            words.append('F' + move.words['F'])
+            feed = move.f
+
+        if words:
+            return move.cmd + ' ' + ' '.join(words)
+        return None
+
+    def release(count):
+        for move in pending[:count]:
+            line = emit(move)
+            if line is not None:
+                yield line
+        del pending[:count]
+
+    # Combine the last two held back moves, True if they were combined
+    def combine():
+        if len(pending) < 2:
+            return False
+        a, b = pending[-2], pending[-1]
+
+        # feedrate only move, the next move takes its feedrate
+        if removeNoops and a.feedOnly():
+            if b.f is None:
+                b.f, b.words['F'] = a.f, a.words['F']
+            del pending[-2]
+            return True
+
+        # Z only moves, keep the last target
+        if not a.movedXY() and not b.movedXY() and a.e == 0 and b.e == 0:
+            words = dict(b.words)
+            if 'F' not in words and 'F' in a.words:
+                words['F'] = a.words['F']
+            merged = Move(b.cmd, words, a.start, b.end)
+            pending[-2:] = [] if removeNoops and not merged.moved() else [merged]
+            return True
+
+        # retract then un-retract in place
+        if foldRetracts and not a.moved() and not b.moved() and a.e < 0 < b.e and abs(a.e + b.e) < EPSILON:
+            del pending[-2:]
+            return True
+
+        # straight continuation of the same line
+        if mergeCollinear and mergeable(a, b):
+            words = dict(b.words)
+            if 'E' in words:
+                words['E'] = str(round(a.e + b.e, 5))
+            for axis in AXES + ('F',):
+                if axis not in words and axis in a.words:
+                    words[axis] = a.words[axis]
+            pending[-2:] = [Move(b.cmd, words, a.start, b.end)]
+            return True
+
+        return False
+
+    for line in lines:
+        raw = line.strip()
+        code = raw.split(';', 1)[0].strip()
+
+        if not code:
+            if not stripComments and raw:
+                yield from release(len(pending))
+                yield raw
+            continue
+
+        cmd = code.split()[0]
+
+        if cmd in ('G0', 'G1') and absolute and relativeE:
+            words = dict(WORD.findall(code[len(cmd):]))
+            end = list(pos)
+            for i, axis in enumerate(AXES):
+                if axis in words:
+                    end[i] = float(words[axis])
+            move = Move(cmd, words, tuple(pos), tuple(end))
+            pos = end
+
+            if not all(known):
+                # nothing to compare against, send as is until every axis has been set
+                known = [k or axis in words for k, axis in zip(known, AXES)]
+                yield from release(len(pending))
+                line = emit(move)
+                if line is not None:
+                    yield line
+                continue
+
+            if dropModal:
+                for i, axis in enumerate(AXES):
+                    if axis in words and abs(move.end[i] - move.start[i]) < EPSILON:
+                        del words[axis] # already there
+
+            if removeNoops and move.feedOnly() and move.f is None:
+                continue # does nothing at all
+
+            pending.append(move)
+            while combine():
+                pass
+
+            # moves under a move in XY can't be combined anymore
+            if pending and pending[-1].movedXY():
+                yield from release(len(pending) - 1)
+            elif len(pending) > WINDOW:
+                yield from release(len(pending) - WINDOW)
+            continue
+
+        # Any other command, send everything held back first
+        yield from release(len(pending))
+
+        if cmd == 'G90':
+            absolute = True
+        elif cmd == 'G91':
+            absolute = False
+        elif cmd == 'M83':
+            relativeE = True
+        elif cmd == 'M82':
+            relativeE = False
+        elif cmd in ('G28', 'G29', 'G80') or (cmd == 'G92' and any(axis in code for axis in AXES)):
+            known = [False, False, False]
+
+        yield code if stripComments else raw
+
+    yield from release(len(pending))
+
+# Two moves are on one straight line, in the same direction, at the same speed and flow
+def mergeable(a, b):
+    if a.cmd != b.cmd or not a.movedXY() or not b.movedXY():
+        return False
+    if abs(a.start[2] - a.end[2]) > EPSILON or abs(b.start[2] - b.end[2]) > EPSILON:
+        return False
+    if b.f is not None and b.f != a.f:
+        return False
+    if a.e < 0 or b.e < 0 or (a.e > 0) != (b.e > 0):
+        return False
+
+    ax, ay = a.end[0] - a.start[0], a.end[1] - a.start[1]
+    bx, by = b.end[0] - b.start[0], b.end[1] - b.start[1]
+    la, lb = a.length(), b.length()
+
+    if ax*bx + ay*by <= 0: # turning back
+        return False
+    if abs(ax*by - ay*bx) / la > COLLINEAR: # distance of b's end from a's line
+        return False
+    if a.e > 0 and abs(a.e/la - b.e/lb) > FLOW_TOLERANCE * (a.e/la):
+        return False
+    return True
+
+# Optimize a whole program given as text
+def optimizeProgram(gcode, **options):
+    return ''.join(line + '\n' for line in optimizeGcode(gcode.split('\n'), **options))
@@ -0,0 +1,103 @@
+import re
+import datetime
+import numpy as np
+from functools import lru_cache
+
+from gcode_gen.generate import GcodeContext, streamProgram, settings, formatTime
+
+# Gcode Templates
+# Particles only differ in extruder temp, travel speed and extrusion multiplier. The toolpath for a
+# (mode, iter, geometry) is generated once, with the particle values left as slots in the text.
+# Rendering a particle only fills the slots, instead of walking the whole geometry again.
+# The time in the header is a slot too, so it is the time of rendering and not of compiling.
+
+SLOT = re.compile('\x00(\\d+)\x00') # slot marker left in the template text
+SLOT_PARAMS = ('moveSpeed', 'extMult') # settings that are filled in per particle
+
+max_templates = 64 # compiled templates kept, least recently used dropped first
+
+# Context that leaves a slot marker wherever a particle value would be written
+class TemplateContext(GcodeContext):
+    def __init__(self, modified_settings=None):
+        GcodeContext.__init__(self, modified_settings)
+        self.kinds = [] # 'Te', 'F', 'E' or 'T' (time) for every slot
+        self.extRatios = [] # E slots, nan for the others
+        self.lengths = []
+
+    def addSlot(self, kind, extRatio=np.nan, length=np.nan):
+        self.kinds.append(kind)
+        self.extRatios.append(extRatio)
+        self.lengths.append(length)
+        return '\x00{}\x00'.format(len(self.kinds) - 1)
+
+    def fmtTemp(self, Te):
+        return self.addSlot('Te')
+
+    def fmtMoveSpeed(self):
+        return self.addSlot('F')
+
+    def fmtTime(self):
+        return self.addSlot('T')
+
+    def fmtExt(self, extRatio, extMult, length):
+        return self.addSlot('E', extRatio, length)
+
+    def fmtMoveSpeeds(self, count):
+        return [self.addSlot('F') for i in range(count)]
+
+    def fmtExts(self, extRatio, extMult, lengths):
+        return [self.addSlot('E', extRatio, length) for length in lengths.tolist()]
+
+class GcodeTemplate:
+    def __init__(self, mode, iter, modified_settings, nozzleD, Tb):
+        ctx = TemplateContext(modified_settings)
+
+        # Walk the geometry once, ctx records the slots
+        text = ''.join(streamProgram(mode, iter, modified_settings, nozzleD, Te=None, Tb=Tb, ctx=ctx))
+
+        # Static text between slots, the i-th slot in the text goes between parts[i] and parts[i+1]
+        pieces = SLOT.split(text)
+        self.parts = pieces[::2]
+
+        # Slots in text order, a whole toolpath can be formatted out of order
+        order = np.array(pieces[1::2], dtype=int)
+        self.kinds = np.array(ctx.kinds)[order]
+        self.extRatios = np.array(ctx.extRatios, dtype=float)[order]
+        self.lengths = np.array(ctx.lengths, dtype=float)[order]
+
+    # Fill the slots for one particle
+    def render(self, Te, moveSpeed, extMult):
+        values = np.empty(len(self.kinds), dtype=object)
+        values[self.kinds == 'Te'] = str(Te)
+        values[self.kinds == 'F'] = str(moveSpeed)
+        values[self.kinds == 'T'] = formatTime(datetime.datetime.now())
+
+        # Rescale all E values in one pass, same operation order as createLine
+        isExt = self.kinds == 'E'
+        ext = self.extRatios[isExt] * extMult * self.lengths[isExt]
+        values[isExt] = [str(round(e, 5)) for e in ext.tolist()]
+
+        gcode = [self.parts[0]]
+        for value, part in zip(values, self.parts[1:]):
+            gcode.append(value)
+            gcode.append(part)
+
+        return ''.join(gcode)
+
+# Get the compiled template for a mode and iteration, compiling it on first use. Only what changes
+# the toolpath is part of the key, the particle values are slots
+def getTemplate(mode, iter, modified_settings, nozzleD, Tb):
+    geometry = {k: v for k, v in modified_settings.items() if k not in SLOT_PARAMS}
+    return compileTemplate(mode, iter, nozzleD, Tb, tuple(sorted(geometry.items())))
+
+@lru_cache(maxsize=max_templates)
+def compileTemplate(mode, iter, nozzleD, Tb, geometry):
+    return GcodeTemplate(mode, iter, dict(geometry), nozzleD, Tb)
+
+# Same output as genProgram, using the template cache
+def renderProgram(mode, iter, modified_settings, nozzleD, Te, Tb):
+    merged = dict(settings)
+    merged.update(modified_settings)
+
+    template = getTemplate(mode, iter, modified_settings, nozzleD, Tb)
+    return template.render(Te, merged['moveSpeed'], merged['extMult'])
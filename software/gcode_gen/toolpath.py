@@ -0,0 +1,97 @@
+import numpy as np
+
+# Vectorized Toolpath Engine
+# Computes whole perimeter and infill paths as arrays of target points, no python loop per segment.
+# A path is (xs, ys, printing): the point every move goes to and whether the move extrudes.
+
+# Box perimeters, stepping inwards by spacing for each perimeter
+# Returns the path and the side of every move: 0 step in, 1 up, 2 right, 3 down, 4 left
+def boxPerimeters(x0, y0, size_x, size_y, spacing, num_perims):
+    i = np.arange(num_perims)
+    sx = x0 + i*spacing # perimeter start, moved inwards after the first perimeter
+    sy = y0 + i*spacing
+    lx = size_x - i*spacing*2 # perimeter side lengths
+    ly = size_y - i*spacing*2
+
+    # step in, up, right, down, left for every perimeter
+    xs = np.stack([sx, sx, sx + lx, sx + lx, sx], axis=1)
+    ys = np.stack([sy, sy + ly, sy + ly, sy, sy], axis=1)
+    sides = np.tile(np.arange(5), (num_perims, 1))
+    printing = sides > 0
+
+    keep = np.ones(xs.shape, dtype=bool)
+    keep[0, 0] = False # no step in before the first perimeter
+
+    return xs[keep], ys[keep], printing[keep], sides[keep]
+
+# 45 degree zig-zag infill between the bounds, line i sits on x + y = xMin + yMin + (i+1)*spacing_45
+# Even lines go from the bottom/right edge to the top/left edge, odd lines the other way
+def boxInfill(xMin, yMin, xMax, yMax, spacing_45, count):
+    width = xMax - xMin
+    height = yMax - yMin
+    c = np.arange(1, count + 1)*spacing_45 # diagonal offset of every line
+
+    # Ends of every line on the bounding box
+    px = xMin + np.minimum(c, width) # bottom/right end
+    py = yMin + np.maximum(c - width, 0)
+    qx = xMin + np.maximum(c - height, 0) # top/left end
+    qy = yMin + np.minimum(c, height)
+
+    even = np.arange(count) % 2 == 0
+    startX = np.where(even, px, qx)
+    startY = np.where(even, py, qy)
+    endX = np.where(even, qx, px)
+    endY = np.where(even, qy, py)
+
+    # travel to the start of a line, then print it
+    xs = np.stack([startX, endX], axis=1).ravel()
+    ys = np.stack([startY, endY], axis=1).ravel()
+    printing = np.tile([False, True], count)
+
+    return xs, ys, printing
+
+# Rotate every point by the print direction around (xm, ym), CW, same as rotateX/rotateY
+def rotate(xs, ys, xm, ym, a):
+    cos = np.cos(a)
+    sin = np.sin(a)
+    rotation = np.array([[cos, sin], [-sin, cos]])
+    dx = xs - xm
+    dy = ys - ym
+
+    # rotation matrix applied to all points, written out so the float operations match rotateX/rotateY
+    xr = (rotation[0, 0] * dx) + (rotation[0, 1] * dy) + xm
+    yr = (rotation[1, 1] * dy) + (rotation[1, 0] * dx) + ym
+    return xr, yr
+
+# Length of every move of a path starting at (x, y)
+def moveLengths(x, y, xs, ys):
+    return np.hypot(np.diff(xs, prepend=x), np.diff(ys, prepend=y))
+
+# Retractions for the travel moves of a path, same rules as moveToXY/doEfeed:
+# retract before travels over 2mm, un-retract after travels of 2mm or more if retracted, so they pair up
+# Returns retract before, un-retract after, and the retracted state after the path
+def travelRetracts(lengths, printing, retracted):
+    travel = ~printing
+    long = travel & (lengths >= 2)
+
+    # Retracted state before each move, stays as is until the first long travel un-retracts
+    before = np.full(len(lengths), retracted)
+    before[1:] &= ~np.logical_or.accumulate(long)[:-1]
+
+    retract = travel & (lengths > 2) & ~before
+    unretract = long & (before | retract) # only what was retracted
+    after = bool(before[-1] and not long[-1]) if len(lengths) else retracted
+
+    return retract, unretract, after
+
+# Which moves of a path run at the z hop height (z hop enabled): from a retract up to the next
+# un-retract, which comes after its move. hopped is the state before the path
+def hoppedMoves(retracts, unretracts, hopped):
+    index = np.arange(len(retracts))
+    lastRetract = np.maximum.accumulate(np.where(retracts, index, -1)) # at or before the move
+    lastUnretract = np.concatenate([[-1], np.maximum.accumulate(np.where(unretracts, index, -1))[:-1]]) # before the move
+    return (lastRetract > lastUnretract) | ((lastRetract == -1) & (lastUnretract == -1) & hopped)
+
+# Format a whole array of coordinates at once
+def formatRounded(values, digits):
+    return [str(round(v, digits)) for v in values.tolist()]
@@ -0,0 +1,71 @@
+import numpy as np
+
+# Travel Planning
+# Orders the objects of a bed so the non printing travel between them is short.
+# Nearest neighbour gives a first order, 2-opt then reverses parts of it while that shortens the path.
+# The path is open and starts at the current toolhead position. An object is entered at its start
+# and left at its end, (x, y) points, so the cost of going from a to b is end of a to start of b and
+# does not have to be the same both ways.
+
+# Travel from the start position (row 0) or the end of every object (rows 1..) to the start of every
+# object (columns 1..). Column 0 is the start position
+def distances(start, starts, ends=None):
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = starts if ends is None else np.asarray(ends, dtype=float).reshape(-1, 2)
+    origin = np.atleast_2d(np.asarray(start, dtype=float))
+    rows = np.vstack([origin, ends])
+    cols = np.vstack([origin, starts])
+    return np.hypot(rows[:, None, 0] - cols[None, :, 0], rows[:, None, 1] - cols[None, :, 1])
+
+# Total travel of a path of matrix indexes, 0 first
+def cost(dist, path):
+    path = np.asarray(path, dtype=int)
+    return float(dist[path[:-1], path[1:]].sum())
+
+# Total travel of visiting the objects in order, from start
+def pathLength(start, starts, order, ends=None):
+    return cost(distances(start, starts, ends), np.concatenate([[0], np.asarray(order, dtype=int) + 1]))
+
+def nearestNeighbour(dist):
+    count = len(dist) - 1
+    visited = np.zeros(count + 1, dtype=bool)
+    visited[0] = True
+    order = []
+    current = 0
+
+    for i in range(count):
+        left = np.where(visited, np.inf, dist[current])
+        current = int(np.argmin(left))
+        visited[current] = True
+        order.append(current)
+
+    return order
+
+# Reverse parts of the path while that makes it shorter. Costs are not symmetric, so every
+# candidate is costed as a whole, beds hold few enough objects for that
+def twoOpt(dist, order):
+    path = [0] + list(order)
+    best = cost(dist, path)
+    improved = True
+
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                candidate = path[:i] + path[i:j + 1][::-1] + path[j + 1:]
+                length = cost(dist, candidate)
+                if length < best - 1e-9:
+                    path, best = candidate, length
+                    improved = True
+
+    return path[1:]
+
+# Order (indexes into starts) to print the objects in, ends are where the objects are left
+# (the starts if None)
+def planOrder(start, starts, ends=None):
+    if len(starts) < 2:
+        return list(range(len(starts)))
+
+    dist = distances(start, starts, ends)
+    order = twoOpt(dist, nearestNeighbour(dist))
+    return [i - 1 for i in order]
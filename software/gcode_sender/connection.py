@@ -0,0 +1,266 @@
+import threading
+import itertools
+from collections import deque
+import time
+import atexit
+import serial.tools.list_ports
+
+from gcode_sender.framing import frameLine, resendNumber, probeBaud
+from gcode_sender.telemetry import Telemetry, REPORT_INTERVAL
+
+# Printer Connection
+# Opening the port resets the MK3S board, so one connection is kept open for the whole campaign and
+# only re-opened when it was lost. The port is looked up once and again only if reconnecting fails.
+# printrun is imported on the first connect, importing this module does not touch the printer.
+
+DEFAULT_PORT = '/dev/ttyACM0'
+ONLINE_TIMEOUT = 30 # sec, board reset and handshake
+LOOKAHEAD = 4 # lines sent ahead of the last ok, the MK3S planner buffer holds 4 commands
+HISTORY = 256 # sent lines kept for resends
+ABORT_CHECK = 1 # sec between calls of a stream's abort check
+# Sent when a stream fails: break an M109/M190 wait, heaters off, quick stop where the firmware has
+# it, motors off. The firmware still runs the few lines it buffered before these
+STOP_COMMANDS = ('M108', 'M104 S0', 'M140 S0', 'M410', 'M84')
+
+# Port of the Prusa, default port if none is found
+def find_port():
+  for device in serial.tools.list_ports.comports():
+    if 'Prusa' in device.description:
+      return device.device
+  return DEFAULT_PORT
+
+class PrinterConnection:
+  # baud None probes the fastest rate the printer answers on, once
+  def __init__(self, port=None, baud=115200):
+    self.port = port
+    self.baud = baud
+    self.p = None
+    self.online = threading.Event()
+    self.telemetry = Telemetry() # temperatures, progress and ok latency read by printcore's listener
+
+    # Streaming flow control, lines sent and lines acknowledged with ok
+    self.acks = threading.Condition()
+    self.sent = 0
+    self.acked = 0
+    self.resend = None # line number the printer asked for again
+    self.last_resend = None
+    self.stale = 0 # resend requests still to come for lines sent before the last resend
+    self.orphans = 0 # oks still to come for lines of a failed stream, not counted for the next one
+
+    # M486 objects of the program being streamed
+    self.current_object = None
+    self.cancelled = set()
+    self.commands = deque() # lines to send before the next line of the program
+
+  def connected(self):
+    return self.p is not None and self.p.printer is not None and self.p.online
+
+  # Open the connection if it is not open, returns the printcore instance
+  def connect(self):
+    if self.connected():
+      return self.p
+
+    self.disconnect()
+    if self.port is None:
+      self.port = find_port()
+    if self.baud is None:
+      self.baud = probeBaud(self.port) or 115200
+
+    if not self.open():
+      # the port can change after a reset, look it up again
+      self.disconnect()
+      self.port = find_port()
+      if not self.open():
+        raise ConnectionError('Printer not online on {}'.format(self.port))
+
+    return self.p
+
+  def open(self):
+    from printrun.printcore import printcore
+
+    self.online.clear()
+    self.p = printcore()
+    self.p.onlinecb = self.online.set
+    self.p.recvcb = self.recv
+    self.p.sendcb = self.sending
+    self.p.connect(self.port, self.baud)
+    if not self.online.wait(ONLINE_TIMEOUT):
+      return False
+
+    # Temperatures are reported by the firmware, no M105 polling. The board was reset, no oks are pending
+    self.telemetry.reset()
+    with self.acks:
+      self.orphans = 0
+    self.p.send_now('M155 S{}'.format(REPORT_INTERVAL))
+    return True
+
+  def disconnect(self):
+    if self.p is not None:
+      self.p.disconnect()
+      self.p = None
+
+  # Called by printcore for every line sent
+  def sending(self, command, gline):
+    self.telemetry.sending(command)
+
+  # Called by printcore for every line received
+  def recv(self, line):
+    self.telemetry.received(line)
+    resend = resendNumber(line)
+    with self.acks:
+      if line.startswith('ok') and self.orphans:
+        self.orphans -= 1
+      elif line.startswith('ok'):
+        self.acked = min(self.acked + 1, self.sent) # oks for printcore's own commands are not ours
+      elif resend is not None:
+        if self.stale and resend == self.last_resend:
+          self.stale -= 1 # lines sent after the broken one are rejected too, each asks for the same line
+        else:
+          self.resend = resend
+          self.last_resend = resend
+          self.stale = self.sent - self.acked - 1
+      self.acks.notify_all()
+
+  # Cancel an M486 object of the program being streamed: its lines that were not sent yet are
+  # dropped, and M486 P makes the firmware skip the ones already in its buffer. M486 P goes out as
+  # the next numbered line, so its ok and resends are counted like the program's
+  def cancel_object(self, id):
+    self.cancelled.add(id)
+    self.commands.append('M486 P{}'.format(id))
+
+  # Stream lines to the printer as they come from an iterator (generator, open file), at most
+  # lookahead lines ahead of the printer. Only the last HISTORY lines are kept for resends, so memory
+  # does not grow with the program. Lines are numbered and checksummed unless numbered is False.
+  # Returns False if it timed out (sec) or the connection was lost, the print is then stopped with
+  # stop_print(). progress(lines) gets the number of lines acknowledged so far. abort() is called every ABORT_CHECK sec, if it returns True the
+  # object being printed is cancelled.
+  def stream_gcode(self, lines, timeout=None, progress=None, lookahead=LOOKAHEAD, numbered=True, abort=None):
+    p = self.connect()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    frame = frameLine if numbered else lambda number, line: line + '\n'
+
+    codes = (line.split(';', 1)[0].strip() for line in lines)
+    # M400 is acknowledged once the last move has finished, not when it is queued
+    codes = itertools.chain((code for code in codes if code), ['M400'])
+
+    history = {0: 'M110'} # number: line, for resends. Line 0 resets the firmware's line number
+    number = 0 # last line taken from lines
+    nxt = 0 if numbered else 1 # number of the next line to send
+
+    # oks of a failed stream come before any of ours, numbering restarts with line 0 below
+    if not self.wait_orphans(ONLINE_TIMEOUT):
+      print('{} oks of the last stream did not come, counting from here'.format(self.orphans))
+    with self.acks:
+      self.orphans = 0
+      self.sent = 0
+      self.acked = 0
+      self.resend = None
+      self.last_resend = None
+      self.stale = 0
+    self.current_object = None
+    self.cancelled = set()
+    self.commands.clear()
+    last_check = time.monotonic()
+
+    while True:
+      with self.acks:
+        if self.resend is not None:
+          nxt, self.resend = self.resend, None
+          if nxt not in history:
+            print('Printer asked for line {} which is no longer kept'.format(nxt))
+            return self.stop_print()
+
+      if abort is not None and time.monotonic() - last_check > ABORT_CHECK:
+        last_check = time.monotonic()
+        if self.current_object is not None and self.current_object not in self.cancelled and abort():
+          self.cancel_object(self.current_object)
+
+      if nxt > number:
+        code = self.next_code(codes)
+        if code is None:
+          # Everything sent, a resend can still come with the last oks
+          if not self.wait_acked(self.sent, deadline):
+            return self.stop_print()
+          with self.acks:
+            if self.resend is None:
+              return True
+          continue
+        number += 1
+        history[number] = code
+        history.pop(number - HISTORY, None)
+
+      if not self.wait_acked(self.sent - lookahead + 1, deadline):
+        return self.stop_print()
+      with self.acks:
+        if self.resend is not None:
+          continue # replay from the resend first
+        self.sent += 1
+      p.send_now(frame(nxt, history[nxt]).strip())
+      nxt += 1
+
+      if progress is not None:
+        progress(self.acked)
+
+  # Next line to send, commands first. Lines of cancelled objects are skipped
+  def next_code(self, codes):
+    if self.commands:
+      return self.commands.popleft()
+    for code in codes:
+      if code.startswith('M486 S'):
+        self.current_object = int(code.split('S')[1])
+        if self.current_object < 0:
+          self.current_object = None
+      elif self.current_object in self.cancelled:
+        continue
+      return code
+    return None
+
+  # Stop a failed print, returns False. The heaters are turned off and nothing more is sent, oks still
+  # to come for what was sent are left out of the next stream's count. A lost connection is closed,
+  # reopening it resets the board which turns the heaters off
+  def stop_print(self):
+    if not self.connected():
+      self.disconnect()
+      return False
+
+    with self.acks:
+      self.orphans += self.sent - self.acked + len(STOP_COMMANDS)
+      self.sent = 0
+      self.acked = 0
+      self.resend = None
+    for command in STOP_COMMANDS:
+      self.p.send_now(command)
+    return False
+
+  # Wait until the oks of a failed stream came, False on timeout
+  def wait_orphans(self, timeout):
+    deadline = time.monotonic() + timeout
+    with self.acks:
+      while self.orphans and self.connected():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return False
+        self.acks.wait(remaining)
+    return True
+
+  # Wait until count lines are acknowledged or a resend is asked for, False on timeout or lost connection
+  def wait_acked(self, count, deadline):
+    with self.acks:
+      while self.acked < count and self.resend is None:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return False
+        self.acks.wait(min(remaining, ONLINE_TIMEOUT) if remaining is not None else ONLINE_TIMEOUT)
+        if not self.connected():
+          return False
+    return True
+
+connection = None
+
+# Connection shared by every print of the process, closed at exit
+def get_connection():
+  global connection
+  if connection is None:
+    connection = PrinterConnection()
+    atexit.register(connection.disconnect)
+  return connection
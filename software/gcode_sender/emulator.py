@@ -0,0 +1,219 @@
+import os
+import re
+import tty
+import time
+import queue
+import random
+import select
+import threading
+
+from gcode_sender.framing import checksum
+
+# Printer Emulator
+# A fake MK3S on a pseudo terminal, so the senders can be tested and benchmarked without a printer.
+# Speaks the Prusa firmware dialect: ok after every command, busy: processing while a command
+# blocks, Resend for bad line numbers or checksums, temperature reports for M105/M109/M155 and the
+# M73 progress message. Moves go through a planner buffer of bufferSize and take moveTime sec each.
+
+WORD = re.compile(r'([A-Z])(-?[\d.]+)')
+
+class PrinterEmulator:
+    def __init__(self, bufferSize=4, moveTime=0.01, errorRate=0, busyInterval=2, heatRate=None, seed=None):
+        self.bufferSize = bufferSize
+        self.moveTime = moveTime # sec per G0/G1, a function of the line can be given instead
+        self.errorRate = errorRate # share of numbered lines answered with a checksum error
+        self.busyInterval = busyInterval # sec between busy messages while blocked
+        self.heatRate = heatRate # deg/sec for M109/M190, None heats instantly
+        self.random = random.Random(seed)
+
+        self.planner = queue.Queue(bufferSize)
+        self.lastN = 0
+        self.temps = {'T': [21.0, 0.0], 'B': [21.0, 0.0]} # current, target
+        self.progress = None # M73 percent done, min remaining
+        self.reportInterval = 0 # M155 auto report, sec, 0 is off
+
+        # Stats
+        self.lines = 0
+        self.moves = 0
+        self.errors = 0
+        self.received = [] # commands accepted, in order
+
+        self.running = False
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave) # no echo, no newline translation
+        self.port = os.ttyname(self.slave)
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=loop, daemon=True) for loop in (self.readLoop, self.planLoop, self.reportLoop)]
+        for thread in self.threads:
+            thread.start()
+        self.write('start')
+        return self
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def write(self, text):
+        os.write(self.master, (text + '\n').encode())
+
+    def readLoop(self):
+        data = b''
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            data += os.read(self.master, 1024)
+            while b'\n' in data:
+                line, data = data.split(b'\n', 1)
+                line = line.decode(errors='replace').strip()
+                if line:
+                    self.handle(line)
+
+    # Executes planned moves
+    def planLoop(self):
+        while self.running:
+            try:
+                line = self.planner.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            time.sleep(self.moveTime(line) if callable(self.moveTime) else self.moveTime)
+            self.planner.task_done()
+
+    # Temperature auto report
+    def reportLoop(self):
+        last = time.monotonic()
+        while self.running:
+            time.sleep(0.05)
+            if self.reportInterval and time.monotonic() - last >= self.reportInterval:
+                self.write(' ' + self.tempReport())
+                last = time.monotonic()
+
+    # Check the line number and checksum of a numbered line, returns the command or None if it was rejected
+    def unframe(self, line):
+        if not line.startswith('N'):
+            return line
+
+        body, star, cs = line.partition('*')
+        number, _, command = body.partition(' ')
+        number = int(number[1:])
+
+        if command.startswith('M110'):
+            self.lastN = number
+            return command
+        if number != self.lastN + 1:
+            return self.resend('Line Number is not Last Line Number+1, Last Line: {}'.format(self.lastN))
+        if not star or checksum(body) != int(cs) or self.random.random() < self.errorRate:
+            self.errors += 1
+            return self.resend('checksum mismatch, Last Line: {}'.format(self.lastN))
+
+        self.lastN = number
+        return command
+
+    def resend(self, error):
+        self.write('Error:' + error)
+        self.write('Resend: {}'.format(self.lastN + 1))
+        self.write('ok')
+        return None
+
+    # Block until done() is True, with busy messages like the firmware
+    def block(self, done, step=0.05):
+        last = time.monotonic()
+        while not done() and self.running:
+            time.sleep(step)
+            if time.monotonic() - last > self.busyInterval:
+                self.write('echo:busy: processing')
+                last = time.monotonic()
+
+    def tempReport(self):
+        return 'T:{0[0]:.1f} /{0[1]:.1f} B:{1[0]:.1f} /{1[1]:.1f} T0:{0[0]:.1f} /{0[1]:.1f} @:0 B@:0'.format(self.temps['T'], self.temps['B'])
+
+    def heat(self, heater):
+        temp = self.temps[heater]
+        if self.heatRate is None:
+            temp[0] = temp[1]
+            return
+        last = time.monotonic()
+        while abs(temp[0] - temp[1]) > 0.5 and self.running:
+            time.sleep(min(1, self.busyInterval))
+            step = self.heatRate*(time.monotonic() - last)
+            last = time.monotonic()
+            temp[0] += max(-step, min(step, temp[1] - temp[0]))
+            self.write(self.tempReport()) # M109 reports while waiting
+
+    def handle(self, line):
+        command = self.unframe(line.split(';', 1)[0].strip())
+        if command is None:
+            return
+
+        self.lines += 1
+        self.received.append(command)
+        cmd = command.split()[0]
+        words = dict(WORD.findall(command[len(cmd):]))
+
+        if cmd in ('G0', 'G1'):
+            self.moves += 1
+            # planner full, the firmware stops reading until a move is done
+            while self.running:
+                try:
+                    self.planner.put(command, timeout=self.busyInterval)
+                    break
+                except queue.Full:
+                    self.write('echo:busy: processing')
+
+        elif cmd in ('M400', 'G28', 'G80'):
+            self.block(lambda: self.planner.unfinished_tasks == 0)
+
+        elif cmd == 'G4':
+            time.sleep(float(words.get('S', 0)) + float(words.get('P', 0))/1000)
+
+        elif cmd in ('M104', 'M109', 'M140', 'M190'):
+            heater = 'T' if cmd in ('M104', 'M109') else 'B'
+            if 'S' in words:
+                self.temps[heater][1] = float(words['S'])
+            if cmd in ('M109', 'M190'):
+                self.block(lambda: self.planner.unfinished_tasks == 0)
+                self.heat(heater)
+
+        elif cmd == 'M105':
+            self.write('ok ' + self.tempReport())
+            return
+
+        elif cmd == 'M155':
+            self.reportInterval = float(words.get('S', 0))
+
+        elif cmd == 'M73':
+            self.progress = (int(float(words.get('P', 0))), int(float(words.get('R', 0))))
+            self.write('NORMAL MODE: Percent done: {}; print time remaining in mins: {}'.format(*self.progress))
+
+        elif cmd == 'M115':
+            self.write('FIRMWARE_NAME:Prusa-Firmware 3.10.0 based on Marlin FIRMWARE_URL:https://github.com/prusa3d/Prusa-Firmware PROTOCOL_VERSION:1.0 MACHINE_TYPE:Prusa i3 MK3S EXTRUDER_COUNT:1')
+
+        self.write('ok')
+
+# Stream a generated program through the emulator and print the sender's throughput
+# Run from software/ as python -m gcode_sender.emulator
+def main(mode='P', iter=1, moveTime=0.001, errorRate=0.01):
+    import serial
+    from gcode_gen.generate import streamLines, streamProgram
+    from gcode_sender.framing import frameLine, resetLineNumbers
+    from gcode_sender.simple_send_gcode import stream, READ_TIMEOUT
+
+    emulator = PrinterEmulator(moveTime=moveTime, errorRate=errorRate, busyInterval=0.5).start()
+    print('Emulator on {}'.format(emulator.port))
+
+    with serial.Serial(emulator.port, 115200, timeout=READ_TIMEOUT) as s:
+        s.readline() # start
+        resetLineNumbers(s)
+        stats = stream(s, streamLines(streamProgram(mode, iter, {}, 0.4, 215, 0)), frame=frameLine)
+
+    print(stats.report())
+    print('Moves: {}. Injected errors: {}.'.format(emulator.moves, emulator.errors))
+    emulator.stop()
+
+if __name__ == '__main__':
+    main()
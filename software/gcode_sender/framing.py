@@ -0,0 +1,54 @@
+import re
+import time
+import serial
+
+# Line Framing
+# Every line is sent as "N<number> <line>*<checksum>". The firmware checks the number and the XOR
+# checksum and answers "Resend: <number>" for a line that arrived broken or out of order, so
+# corruption on a faster link is resent instead of printed.
+
+BAUD_RATES = (250000, 230400, 115200) # fastest first
+PROBE_TIMEOUT = 5 # sec, board reset after opening the port plus the answer
+RESEND = re.compile(r'^(?:Resend|rs)\D*(\d+)')
+
+# XOR of all characters, as checked by Marlin/Prusa firmware
+def checksum(text):
+  cs = 0
+  for c in text.encode():
+    cs ^= c
+  return cs
+
+def frameLine(number, line):
+  text = 'N{} {}'.format(number, line)
+  return '{}*{}\n'.format(text, checksum(text))
+
+# Line number asked for by a resend reply, None for any other reply
+def resendNumber(reply):
+  match = RESEND.match(reply)
+  return int(match.group(1)) if match else None
+
+# Line 0 sets the firmware's line number, the next line must be N1
+def resetLineNumbers(s, timeout=PROBE_TIMEOUT):
+  s.write(frameLine(0, 'M110').encode())
+  return waitOk(s, timeout)
+
+def waitOk(s, timeout):
+  end = time.monotonic() + timeout
+  while time.monotonic() < end:
+    if s.readline().decode(errors='replace').strip().startswith('ok'):
+      return True
+  return False
+
+# Fastest baud rate the printer answers on, the firmware has no command to change it so every
+# rate is tried. Opening the port resets the board, so this is done once per session.
+def probeBaud(port, rates=BAUD_RATES, timeout=PROBE_TIMEOUT):
+  for baud in rates:
+    try:
+      with serial.Serial(port, baud, timeout=1) as s:
+        time.sleep(2) # board reset
+        s.reset_input_buffer()
+        if resetLineNumbers(s, timeout):
+          return baud
+    except serial.SerialException:
+      pass
+  return None
@@ -1,44 +1,36 @@
 # install printcore and install pyserial
 
-from printrun.printcore import printcore
-from printrun import gcoder
-import time
-import serial.tools.list_ports
+from gcode_sender.connection import get_connection
+import asyncio
 
-def send_gcode(iter, gcode_file): 
+# Lines are streamed to the printer as they are read, a few lines ahead of the printer's oks, so
+# programs are never loaded whole. The connection stays open between prints, see connection.py
 
-  port = '/dev/ttyACM0' # Default port
+# Print a program and block until the printer has taken the last line, returns False if it was
+# stopped after timeout (sec). progress(lines) gets the number of lines acknowledged so far
+# abort() is checked while printing, if it returns True the object being printed is cancelled (M486)
+def send_gcode(iter, gcode_file, timeout=None, progress=None, connection=None, abort=None): 
 
-  # Auto Connect to Prusa
-  for device in serial.tools.list_ports.comports(): 
-    if 'Prusa' in device.description: 
-      port = device.device
+  if connection is None: 
+    connection = get_connection()
 
-  p = printcore(port , 115200) #  Instance of Printcore
-  gcode = [i.strip() for i in open(gcode_file)] # Process Gcode read from file
-  gcode = gcoder.LightGCode(gcode) # Process Gcode
+  # Gcode can be a file name or any iterable of lines, e.g. streamLines(streamProgram(...))
+  if isinstance(gcode_file, str): 
+    with open(gcode_file) as f: 
+      return send_gcode(iter, f, timeout, progress, connection, abort)
 
-  # Startprint silently exits if not connected yet, this is important to initiate print
-  while not p.online:
-    time.sleep(0.1)
+  print('Printing...')
+  if not connection.stream_gcode(gcode_file, timeout, progress, abort=abort): 
+    print('Print {} did not complete (timeout {} sec or connection lost)'.format(iter, timeout))
+    return False
 
-  p.startprint(gcode) # Start the print
+  print('Print {} Complete'.format(iter))
+  return True
 
-  # Print Progress if printing, otherwise disconnect
-  last_val = 0
-  print('Printing...')
-  while p.printing:
-    # Display progress
-    current = round(100 * float(p.queueindex) / len(p.mainqueue))
-
-    if last_val is not current:
-      # print('Progress: {}'.format(current))
-
-      last_val = current
-    
-  else:
-    print('Print {} Complete'.format(iter))
-    p.disconnect()
+# Awaitable send_gcode, the print runs in a worker thread that sleeps until printcore reports the end
+async def send_gcode_async(iter, gcode_file, timeout=None, progress=None, connection=None, abort=None): 
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, send_gcode, iter, gcode_file, timeout, progress, connection, abort)
       
 # List all com connected devices
 # for device in serial.tools.list_ports.comports(): 
@@ -1,8 +1,19 @@
 # Send gcode using UART pins using serial
 # https://onehossshay.wordpress.com/2011/08/26/grbl-a-simple-python-interface/
 
+# Lines are streamed with character counting (like grbl's stream.py): the bytes of every line that
+# has not been answered with ok are counted, and the next line is sent as soon as it fits in the
+# firmware's serial RX buffer, instead of waiting for the ok of every line.
+
 import serial
 import time
+from collections import deque
+
+from gcode_sender.framing import frameLine, resendNumber, resetLineNumbers, probeBaud
+
+RX_BUFFER_SIZE = 128 # bytes, serial receive buffer of the MK3S firmware
+READ_TIMEOUT = 1 # sec, serial read timeout, busy printers keep sending busy: messages
+REPLY_TIMEOUT = 30 # sec without any reply before the printer is taken as lost
 
 def removeComment(string):
 	if (string.find(';')==-1):
@@ -10,33 +21,141 @@ def removeComment(string):
 	else:
 		return string[:string.index(';')]
 
-# Open serial port
-s = serial.Serial("/dev/ttyUSB0",115200)
-print('Opening Serial Port')
- 
-# Open g-code file
-f = open('gcode.gcode','r')
-print('Opening gcode file')
- 
-# Wake up 
-s.write("\r\n\r\n") # Hit enter a few times to wake the Printrbot
-time.sleep(2)   # Wait for initialize
-s.reset_input_buffer()  # Flush startup text in serial input
-print('Sending gcode')
- 
-# Stream g-code
-for line in f:
-	l = removeComment(line)
-	l = l.strip() # Strip all EOL characters for streaming
-	if l.isspace()==False and len(l)>0:
-		print('Sending: ' + l)
-		s.write(l + '\n') # Send g-code block
-		grbl_out = s.readline() # Wait for response with carriage return
-		print(' : ' + grbl_out.strip())
- 
-# Wait here until printing is finished to close serial port and file.
-input("Press <Enter> to exit.")
- 
-# Close file and serial port
-f.close()
-s.close()
\ No newline at end of file
+# Plain line, no line number
+def plainFrame(number, line):
+	return line + '\n'
+
+# Throughput of a stream
+class StreamStats:
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.end = None
+		self.lines = 0
+		self.bytes = 0
+		self.resends = 0
+		self.latencies = [] # sec from sending a line to its ok
+
+	def report(self):
+		elapsed = (self.end or time.perf_counter()) - self.start
+		rate = self.lines / elapsed if elapsed > 0 else 0
+		latency = sum(self.latencies) / len(self.latencies) if self.latencies else 0
+		return 'Lines: {}. Bytes: {}. Resends: {}. Time: {:.1f} s. Throughput: {:.1f} lines/s. Mean ok latency: {:.1f} ms.'.format(
+			self.lines, self.bytes, self.resends, elapsed, rate, latency*1000)
+
+# Stream lines (file, generator) to the printer, keeping its RX buffer as full as possible
+# frame(number, line) gives the text sent for a line, see framing.py for numbered lines with checksums
+# Raises ConnectionError if the printer does not answer for timeout sec while lines are unanswered
+def stream(s, lines, frame=plainFrame, rxBufferSize=RX_BUFFER_SIZE, verbose=False, timeout=REPLY_TIMEOUT):
+	stats = StreamStats()
+	inflight = deque() # (number, bytes, time sent) of lines not answered yet
+	history = {} # number: line, kept until the line is answered in case it has to be sent again
+	pending = deque() # lines waiting for room in the RX buffer
+	number = 0 # number of the last line sent
+	skipOk = 0 # oks of lines the firmware rejected
+	stale = 0 # resend requests still to come for lines sent after a rejected line
+	lastResend = None
+	lastReply = time.monotonic()
+
+	# Handle one reply from the printer
+	def reply():
+		nonlocal number, skipOk, stale, lastResend, lastReply
+
+		out = s.readline().decode(errors='replace').strip()
+		if not out:
+			# read timed out, keep waiting unless the printer went silent
+			if time.monotonic() - lastReply > timeout:
+				raise ConnectionError('No reply from the printer in {} sec, {} lines unanswered'.format(timeout, len(inflight) + skipOk))
+			return
+		lastReply = time.monotonic()
+		if verbose:
+			print(' : ' + out)
+
+		if out.startswith('ok'):
+			if skipOk:
+				skipOk -= 1
+			elif inflight:
+				n, size, sent = inflight.popleft()
+				history.pop(n, None)
+				stats.latencies.append(time.perf_counter() - sent)
+
+		elif stale and resendNumber(out) == lastResend:
+			stale -= 1 # every line sent after the rejected one asks for the same line
+
+		elif resendNumber(out) is not None:
+			# The firmware drops every line from the one asked for, send them all again
+			# Every dropped line is still answered with ok
+			resend = resendNumber(out)
+			stats.resends += 1
+			skipOk += len(inflight)
+			stale = len(inflight) - 1
+			lastResend = resend
+			pending.extendleft(reversed([history[n] for n in range(resend, number + 1) if n in history]))
+			inflight.clear()
+			number = resend - 1
+
+		elif out.startswith('Error'):
+			print('Printer error: ' + out)
+
+		# busy: and echo: lines only tell that the printer is alive
+
+	# Send pending lines while they fit in the RX buffer
+	def flush():
+		nonlocal number
+
+		while pending:
+			data = frame(number + 1, pending[0]).encode()
+			if inflight and sum(size for n, size, sent in inflight) + len(data) > rxBufferSize:
+				reply() # a resend can change the pending lines, so frame again after every reply
+				continue
+
+			number += 1
+			history[number] = pending.popleft()
+			if verbose:
+				print('Sending: ' + data.decode().strip())
+			s.write(data)
+			inflight.append((number, len(data), time.perf_counter()))
+			stats.bytes += len(data)
+
+	for line in lines:
+		line = removeComment(line).strip() # Strip all EOL characters for streaming
+		if line:
+			pending.append(line)
+			stats.lines += 1
+			flush()
+
+	# Wait for the last answers, a resend can still put lines back
+	while inflight or skipOk:
+		reply()
+		flush()
+
+	stats.end = time.perf_counter()
+	return stats
+
+# Run from software/ as python -m gcode_sender.simple_send_gcode
+def main(port="/dev/ttyUSB0", filename='gcode.gcode'):
+	# Fastest baud rate the printer answers on
+	baud = probeBaud(port) or 115200
+	print('Baud rate: {}'.format(baud))
+
+	# Open serial port
+	s = serial.Serial(port, baud, timeout=READ_TIMEOUT)
+	print('Opening Serial Port')
+
+	# Wake up
+	s.write(b"\r\n\r\n") # Hit enter a few times to wake the Printrbot
+	time.sleep(2)   # Wait for initialize
+	s.reset_input_buffer()  # Flush startup text in serial input
+	resetLineNumbers(s) # numbered lines start at N1
+	print('Sending gcode')
+
+	# Stream g-code, numbered and checksummed
+	with open(filename, 'r') as f:
+		stats = stream(s, f, frame=frameLine, verbose=True)
+	print(stats.report())
+
+	# Wait here until printing is finished to close serial port
+	input("Press <Enter> to exit.")
+	s.close()
+
+if __name__ == '__main__':
+	main()
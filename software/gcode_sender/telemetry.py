@@ -0,0 +1,71 @@
+import re
+import threading
+from collections import deque
+from time import perf_counter, time
+
+# Printer Telemetry
+# Parses what the printer sends back while printing: temperature reports (auto reported with M155),
+# the M73 progress message and the delay between sending a line and its ok. Readings are kept in
+# bounded ring buffers, the sender's reader thread adds to them and anyone can read a snapshot.
+
+TEMPERATURE = re.compile(r'\b(T|B):\s*(-?[\d.]+)\s*/\s*(-?[\d.]+)')
+PROGRESS = re.compile(r'(NORMAL|SILENT) MODE: Percent done: (-?\d+); print time remaining in mins: (-?\d+)')
+REPORT_INTERVAL = 2 # sec, M155 auto report interval
+
+class Telemetry:
+    def __init__(self, maxlen=1000):
+        self.lock = threading.Lock()
+        self.temperatures = deque(maxlen=maxlen) # (time, hotend, hotend target, bed, bed target)
+        self.progress = deque(maxlen=maxlen) # (time, mode, percent done, min remaining)
+        self.latencies = deque(maxlen=maxlen) # sec from sending a line to its ok
+        self.sent = deque() # send times of lines waiting for their ok
+
+    # Every line sent to the printer
+    def sending(self, line):
+        self.sent.append(perf_counter())
+
+    # Every line received from the printer
+    def received(self, line):
+        if line.startswith('ok') and self.sent:
+            self.latencies.append(perf_counter() - self.sent.popleft())
+
+        temps = dict((heater, (float(current), float(target))) for heater, current, target in TEMPERATURE.findall(line))
+        if 'T' in temps:
+            bed = temps.get('B', (None, None))
+            with self.lock:
+                self.temperatures.append((time(), temps['T'][0], temps['T'][1], bed[0], bed[1]))
+
+        progress = PROGRESS.search(line)
+        if progress:
+            with self.lock:
+                self.progress.append((time(), progress.group(1).lower(), int(progress.group(2)), int(progress.group(3))))
+
+    # Line numbering restarted, pending oks are for nothing
+    def reset(self):
+        self.sent.clear()
+
+    # Latest values, for the orchestrator and the web UI
+    def snapshot(self):
+        with self.lock:
+            temperature = self.temperatures[-1] if self.temperatures else None
+            progress = self.progress[-1] if self.progress else None
+            latencies = list(self.latencies)
+
+        return {
+            'time': temperature[0] if temperature else None,
+            'hotend': temperature[1] if temperature else None,
+            'hotendTarget': temperature[2] if temperature else None,
+            'bed': temperature[3] if temperature else None,
+            'bedTarget': temperature[4] if temperature else None,
+            'percentDone': progress[2] if progress else None,
+            'minutesRemaining': progress[3] if progress else None,
+            'meanOkLatency': sum(latencies) / len(latencies) if latencies else None,
+        }
+
+    # Temperature readings of the last seconds, all of them if seconds is None
+    def history(self, seconds=None):
+        with self.lock:
+            readings = list(self.temperatures)
+        if seconds is not None:
+            readings = [reading for reading in readings if reading[0] >= time() - seconds]
+        return readings
@@ -0,0 +1,83 @@
+import threading
+import numpy as np
+from time import perf_counter, sleep
+
+# Load Cell Acquisition
+# A background thread samples all load cells continuously into a fixed size ring buffer of
+# timestamped weights, so a measurement is a query over data already collected instead of a
+# blocking read. Samples where a cell did not answer are stored as NaN and left out of queries.
+# Raw readings are converted with calibration when given, else with the hx711's own zero and multiples.
+
+class Acquisition:
+    def __init__(self, hx711, cells=4, size=6000, readings=1, calibration=None):
+        self.hx711 = hx711
+        self.calibration = calibration
+        self.readings = readings # conversions averaged per sample, the HX711 runs at about 10 Hz
+        self.size = size # samples kept, 10 min at 10 Hz
+
+        self.lock = threading.Lock()
+        self.times = np.full(size, np.nan) # perf_counter of every sample
+        self.weights = np.full((size, cells), np.nan) # g per cell
+        self.count = 0 # samples taken, the next one goes to count % size
+        self.dropped = 0 # samples with a cell missing
+        self.started = None
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.started = perf_counter()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def loop(self):
+        while self.running:
+            try:
+                raw = self.hx711.read_raw(self.readings)
+                weights = self.calibration.weights(raw) if self.calibration is not None else self.hx711.get_weight()
+            except Exception as e:
+                print(e)
+                sleep(0.1)
+                continue
+
+            weights = [np.nan if weight is None else weight for weight in weights]
+            if np.isnan(weights).any():
+                self.dropped += 1
+            self.add(perf_counter(), weights)
+
+    def add(self, time, weights):
+        with self.lock:
+            i = self.count % self.size
+            self.times[i] = time
+            self.weights[i] = weights
+            self.count += 1
+
+    # Samples of the last seconds (all of them if None), oldest first: times, weights per cell
+    def window(self, seconds=None):
+        with self.lock:
+            n = min(self.count, self.size)
+            order = np.arange(self.count - n, self.count) % self.size
+            times = self.times[order]
+            weights = self.weights[order]
+
+        keep = ~np.isnan(weights).any(axis=1)
+        if seconds is not None:
+            keep &= times >= perf_counter() - seconds
+        return times[keep], weights[keep]
+
+    # Total mass on the bed of every sample of the last seconds
+    def totals(self, seconds=None):
+        times, weights = self.window(seconds)
+        return times, weights.sum(axis=1)
+
+    # Block until the thread has been sampling for seconds, so a window of seconds is full
+    def wait(self, seconds):
+        while self.running and perf_counter() - self.started < seconds:
+            sleep(0.05)
@@ -1,83 +1,58 @@
 from hx711_multi import HX711
-import statistics
-import time
 import RPi.GPIO as GPIO  # import GPIO
-import numpy as np
+from load_cell.calibration import fit_calibration, calibration_file
 
-GPIO.setmode(GPIO.BCM)  # set GPIO pin mode to BCM numbering
+# Calibrate all Load Cells Together
+# Reads the raw value of every cell for the empty bed and for known weights at several places on the
+# bed, fits gain and offset per cell and stores them for load_cell/mass.py.
+# Run from software/ as python -m load_cell.calibrate_all
 
-readings_to_average = 10
+readings_to_average = 30
 sck_pin = 6
 dout_pins = [22, 4, 17, 27]
 
-hx711 = HX711(dout_pins=dout_pins,
-              sck_pin=sck_pin,
-              channel_A_gain=128,
-              channel_select='A',
-              all_or_nothing=False,
-              log_level='CRITICAL')
+# (weight in g, place on the bed), weights off the middle tell the cells apart
+placements = [(0, 'middle'), (1, 'middle'), (2, 'middle'), (5, 'middle'), (10, 'middle'),
+              (10, 'front left'), (10, 'front right'), (10, 'back right'), (10, 'back left'), (0, 'middle')]
 
-# reset ADC, zero it
-hx711.reset()
+def read_raw(hx711):
+    raw = hx711.read_raw(readings_to_average) # Read the Raw Values of Each Load Cell
 
-try:
-    hx711.zero(readings_to_average)
-except Exception as e:
-    print(e)
+    # prevent none values
+    while None in raw:
+        raw = hx711.read_raw(readings_to_average)
+    return raw
 
-# Function to Calibrate all Load Cells Together
-def calibrate_all(known_weights): 
-    avg_multiples = []
-    individual_multiples = []
-    i = 0 
-    for weight_ref in known_weights: 
-        # Tare
-        hx711.reset()
+def calibrate_all(hx711, placements=placements, path=calibration_file):
+    raw = []
+    for weight_ref, place in placements:
+        if weight_ref == 0:
+            input("Please clear the bed and press enter.")
+        else:
+            input("Please put the {}g weight at the {} of the bed and press enter.".format(weight_ref, place))
+        raw.append(read_raw(hx711))
 
-        try:
-            hx711.zero(readings_to_average)
-        except Exception as e:
-            print(e)
-            
-        # Input Prompt
-        input("Please put {}g weight on the bed.".format(weight_ref))
-        time.sleep(1) # sleep to prevent none values
+    calibration = fit_calibration(raw, [weight_ref for weight_ref, place in placements])
 
-        raw = hx711.read_raw(readings_to_average*3) # Read the Raw Values of Each Load Cell
+    for i, (multiple, offset) in enumerate(zip(calibration.multiples, calibration.offsets)):
+        print("Load Cell-{}: multiple {}, offset {}".format(i + 1, multiple, offset))
+    print("RMS error: {:.3f} g".format(calibration.residual))
 
-        # prevent none values
-        while None in raw: 
-            raw = hx711.read_raw(readings_to_average*3)
+    calibration.save(path)
+    print("Saved to {}".format(path))
+    return calibration
 
-        weight_sum = sum(raw) # Sum up all weight readings
-        avg_multiples.append((weight_sum/(weight_ref))) # Calculate the multiple
+if __name__ == '__main__':
+    GPIO.setmode(GPIO.BCM)  # set GPIO pin mode to BCM numbering
 
-        individual_cell_multiple = []
-        for value in raw: 
-            multiple_diff = (avg_multiples[i] - value/weight_ref)/avg_multiples[i] # Relative difference of individual load cell vs. the average
-            individual_cell_multiple.append(avg_multiples[i]*(1 + multiple_diff))  # Adjustment to the individual multiple
+    hx711 = HX711(dout_pins=dout_pins,
+                  sck_pin=sck_pin,
+                  channel_A_gain=128,
+                  channel_select='A',
+                  all_or_nothing=False,
+                  log_level='CRITICAL')
+    hx711.reset()
 
-        individual_multiples.append(individual_cell_multiple) # Add all four multiples with adjustment
+    calibrate_all(hx711)
 
-        i += 1 # Next calibration weight
-
-        input("Please take the weight off.\n")
-
-    # Standard Dev of Values in Multiples
-    # print(statistics.stdev(avg_multiples)) # Avg Value of the multiple across four cells
-
-    # Avg the individual Weights and Print
-    individual = np.transpose(individual_multiples)
-
-    print("Average Multiples: {}".format(avg_multiples))
-    print("Average: {}".format(sum(avg_multiples)/len(avg_multiples)))
-
-    i = 1
-    for multiple in individual: 
-        print("Load Cell-{}: {}. Stddev: {}".format(i, sum(multiple)/len(multiple), statistics.stdev(multiple)))
-        i+=1
-        
-
-# Run Script to find best, for future auto run calibration at start
-weights = [1, 2, 5, 10]
-calibrate_all(weights)
\ No newline at end of file
+    GPIO.cleanup()
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import numpy as np
+
+# Load Cell Calibration
+# Gain and offset of every cell, fitted by least squares over all reference placements: a placement
+# is the raw reading of every cell with a known weight on the bed (0 g for the empty bed), so
+#   weight = sum over cells of (raw - offset) / multiple
+# Offsets come from the empty bed placements. A weight in the middle of the bed loads all cells
+# alike, so the multiples are pulled towards their common value unless placements off the middle
+# tell them apart. The result is stored in a versioned JSON file and loaded at runtime.
+
+CALIBRATION_VERSION = 1 # bump when the file format changes
+calibration_file = './load_cell/calibration.json'
+max_age = 30*24*60*60 # sec, older calibrations are reported as stale
+
+class Calibration:
+    def __init__(self, multiples, offsets, created=None, references=None, residual=None):
+        self.multiples = np.asarray(multiples, dtype=float) # raw per g, as hx711_multi's weight multiples
+        self.offsets = np.asarray(offsets, dtype=float) # raw of the empty bed
+        self.created = created if created is not None else time.time()
+        self.references = references # g of every placement it was fitted from
+        self.residual = residual # rms error of the fit, g
+
+    # g per cell of a raw reading, None for cells that did not answer
+    def weights(self, raw):
+        return [None if value is None else float((value - offset)/multiple) for value, offset, multiple in zip(raw, self.offsets, self.multiples)]
+
+    def age(self):
+        return time.time() - self.created
+
+    def save(self, path=calibration_file):
+        data = {
+            'version': CALIBRATION_VERSION,
+            'created': self.created,
+            'multiples': self.multiples.tolist(),
+            'offsets': self.offsets.tolist(),
+            'references': self.references,
+            'residual': self.residual,
+        }
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp, path)
+
+# Fit from raw readings (placements x cells) and the reference weights (g) of the placements
+def fit_calibration(raw, references, smoothing=0.1):
+    raw = np.asarray(raw, dtype=float)
+    references = np.asarray(references, dtype=float)
+
+    empty = references == 0
+    if not empty.any():
+        raise ValueError("Calibration needs at least one empty bed placement")
+    offsets = raw[empty].mean(axis=0)
+    loads = raw - offsets
+
+    # Common gain of all cells first, then per cell gains pulled towards it
+    common = np.linalg.lstsq(loads.sum(axis=1, keepdims=True), references, rcond=None)[0][0]
+    cells = loads.shape[1]
+    scale = np.sqrt(np.mean(loads**2)) if loads.any() else 1
+    A = np.vstack((loads, smoothing*scale*np.eye(cells)))
+    b = np.concatenate((references, smoothing*scale*common*np.ones(cells)))
+    gains = np.linalg.lstsq(A, b, rcond=None)[0]
+
+    residual = float(np.sqrt(np.mean((loads @ gains - references)**2)))
+    return Calibration(1/gains, offsets, references=references.tolist(), residual=residual)
+
+# Stored calibration, None if there is none or it is from another version
+def load_calibration(path=calibration_file, maxAge=max_age):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        print("No load cell calibration at {}, run load_cell/calibrate_all.py".format(path))
+        return None
+
+    if data.get('version') != CALIBRATION_VERSION:
+        print("Load cell calibration at {} is version {}, expected {}. Recalibrate.".format(path, data.get('version'), CALIBRATION_VERSION))
+        return None
+
+    calibration = Calibration(data['multiples'], data['offsets'], data['created'], data.get('references'), data.get('residual'))
+    if calibration.age() > maxAge:
+        print("Load cell calibration is {:.0f} days old, recalibrate soon.".format(calibration.age()/(24*60*60)))
+    return calibration
@@ -0,0 +1,121 @@
+import numpy as np
+
+# Load Cell Drift Model
+# Fitted online from idle periods of the sample stream, runs where the bed load did not change and the
+# total is stable. Within every idle run a cell reads
+#   level of the run + rate*t + creep*sum of load*log(1 + (t - placed)/tau)
+# with t in sec and the sum over the loads (g per cell) put on the bed since the tare before the run,
+# each from the time it was placed. Every run keeps the loads it saw, a later tare does not change
+# them. Levels are fitted per run, rate and creep are shared by all runs.
+# A measurement is corrected by the drift since the tare: the rate over the time since the tare and
+# the creep of every load since it was placed. Coefficients the idle runs do not tell apart from
+# noise (under significance standard errors) are not applied.
+
+class DriftModel:
+    def __init__(self, cells=4, tau=60, window=2, tolerance=0.05, minDuration=20, maxRuns=50, significance=3):
+        self.tau = tau # sec, creep time constant
+        self.window = window # sec, rolling window of the stability test
+        self.tolerance = tolerance # g, std of the total over the window for idle
+        self.minDuration = minDuration # sec, shorter idle runs are not fitted
+        self.maxRuns = maxRuns # idle runs kept for the fit, oldest dropped
+        self.significance = significance # standard errors a coefficient must exceed to be applied
+
+        self.coef = np.zeros((cells, 2)) # rate g/sec, creep 1/g per cell
+        self.runs = [] # (times, weights, loads) of every idle run, loads as when the run was added
+        self.zero = None # (time, weights) of the last tare
+        self.loads = [] # (time placed, g per cell) of every load since the tare
+
+    # Tare, drift is corrected from here on
+    def start(self, time, weights):
+        self.zero = (time, np.asarray(weights, dtype=float))
+        self.loads = []
+
+    # A load was placed on the bed at time (end of a print), weights are the cells' readings with it
+    def load(self, time, weights):
+        if self.zero is None:
+            return
+        level = self.zero[1] + sum((load for placed, load in self.loads), np.zeros(len(self.zero[1])))
+        self.loads.append((time, np.asarray(weights, dtype=float) - level))
+
+    # Creep basis of one cell at times, every load placed before times[0] creeps from when it was placed
+    def creepBasis(self, cell, times, loads):
+        basis = np.zeros(len(times))
+        for placed, load in loads:
+            if placed <= times[0]:
+                basis += load[cell]*np.log1p((times - placed)/self.tau)
+        return basis
+
+    # Index ranges [start, end) of the idle runs in the samples
+    def findIdle(self, times, weights):
+        if len(times) < 2:
+            return []
+        rate = (len(times) - 1)/(times[-1] - times[0]) if times[-1] > times[0] else 0
+        k = max(int(self.window*rate), 2)
+        if len(times) < k:
+            return []
+
+        totals = weights.sum(axis=1)
+        std = np.lib.stride_tricks.sliding_window_view(totals, k).std(axis=1)
+        stable = np.zeros(len(times), dtype=bool)
+        stable[k - 1:] = std <= self.tolerance
+        stable[1:] &= np.diff(times) < 1 # gaps in sampling end a run
+
+        runs = []
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], stable.astype(int), [0]))))
+        for start, end in zip(edges[::2], edges[1::2]):
+            start = max(start - (k - 1), 0) # the window ending at start was stable from its first sample
+            if times[end - 1] - times[start] >= self.minDuration:
+                runs.append((start, end))
+        return runs
+
+    # Add the idle runs of the samples that were not fitted yet, and refit
+    def update(self, times, weights):
+        last = self.runs[-1][0][-1] if self.runs else -np.inf
+        for start, end in self.findIdle(times, weights):
+            if times[end - 1] <= last:
+                continue
+            keep = times[start:end] > last # the earlier part of a run still growing was fitted already
+            run = (times[start:end][keep], weights[start:end][keep], list(self.loads))
+            if len(run[0]) >= 2:
+                self.runs.append(run)
+        self.runs = self.runs[-self.maxRuns:]
+        self.fit()
+
+    # Least squares of all runs, per cell. Coefficients within significance standard errors of 0 are 0
+    def fit(self):
+        if not self.runs:
+            return
+
+        for cell in range(self.coef.shape[0]):
+            rows = []
+            values = []
+            for r, (times, weights, loads) in enumerate(self.runs):
+                levels = np.zeros((len(times), len(self.runs)))
+                levels[:, r] = 1
+                rows.append(np.column_stack((levels, times - times[0], self.creepBasis(cell, times, loads))))
+                values.append(weights[:, cell])
+            A = np.vstack(rows)
+            b = np.concatenate(values)
+
+            solution, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+            dof = len(b) - rank
+            if dof <= 0:
+                self.coef[cell] = 0
+                continue
+            sigma2 = np.sum((A @ solution - b)**2)/dof
+            errors = np.sqrt(np.maximum(np.diag(sigma2*np.linalg.pinv(A.T @ A)), 0))[-2:]
+
+            coef = solution[-2:]
+            self.coef[cell] = np.where(np.abs(coef) > self.significance*errors, coef, 0)
+
+    # Drift of every cell since the tare, g
+    def drift(self, time):
+        if self.zero is None:
+            return np.zeros(self.coef.shape[0])
+        zeroTime, zeroWeights = self.zero
+
+        rate, creep = self.coef.T
+        drift = rate*(time - zeroTime)
+        for placed, load in self.loads:
+            drift += creep*load*np.log1p(max(time - placed, 0)/self.tau)
+        return drift
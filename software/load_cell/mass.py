@@ -1,87 +1,147 @@
 #https://pypi.org/project/hx711-multi/
 
-from hx711_multi import HX711
-from time import perf_counter, sleep
-import RPi.GPIO as GPIO  # import GPIO
-
-GPIO.setmode(GPIO.BCM)  # set GPIO pin mode to BCM numbering
+import atexit
+import threading
+from time import perf_counter
+import numpy as np
+from load_cell.acquisition import Acquisition
+from load_cell.settling import settle
+from load_cell.drift import DriftModel
+from load_cell.calibration import load_calibration
+
+# The load cells are opened on the first tare or measurement, importing this module does not
+# touch the GPIO
 
 readings_to_average = 10
 sck_pin = 6
 dout_pins = [22, 4, 17, 27] # 1, 2, 3, 4
-weight_multiples = [1548.7454833984375, 1579.536865234375, 1492.9583740234375, 1619.2198486328125] # 128 gain
-
-# create hx711 instance
-hx711 = HX711(dout_pins=dout_pins,
-            sck_pin=sck_pin,
-            channel_A_gain=128,
-            channel_select='A',
-            all_or_nothing=False,
-            log_level='CRITICAL')
-hx711.set_weight_multiples(weight_multiples=weight_multiples)
-
+default_multiples = [1548.7454833984375, 1579.536865234375, 1492.9583740234375, 1619.2198486328125] # 128 gain, until calibrate_all.py is run
+
+tare_window = 3 # sec of samples averaged by tare()
+settle_window = 1.5 # sec of samples that must be stable for measure_mass()
+settle_tolerance = 0.1 # g, allowed std and drift over the settle window
+settle_timeout = 20 # sec, measure_mass() returns the last reading if the scale does not settle
+outlier_range = 10 # g, totals further than this from the median of their window are dropped
+min_valid = 0.5 # share of a window's samples that must be kept, else the reading fails
+recent_window = 2 # sec of samples of recent_mass()
+
+acquisition = None
+drift = None
+lock = threading.Lock()
+
+# Acquisition shared by every measurement of the process, the cells are opened on the first call
+def get_acquisition():
+    global acquisition, drift
+    with lock:
+        if acquisition is None:
+            from hx711_multi import HX711
+            import RPi.GPIO as GPIO  # import GPIO
+
+            GPIO.setmode(GPIO.BCM)  # set GPIO pin mode to BCM numbering
+
+            # create hx711 instance
+            hx711 = HX711(dout_pins=dout_pins,
+                        sck_pin=sck_pin,
+                        channel_A_gain=128,
+                        channel_select='A',
+                        all_or_nothing=False,
+                        log_level='CRITICAL')
+
+            # reset ADC, gains and offsets come from the stored calibration, tares are read from the samples
+            hx711.reset()
+            calibration = load_calibration()
+
+            # no calibration yet, zero the ADC once and use the default multiples
+            if calibration is None:
+                hx711.set_weight_multiples(weight_multiples=default_multiples)
+                try:
+                    hx711.zero(readings_to_average*3) # 30 readings
+                except Exception as e:
+                    print(e)
+
+            # creep and drift since the last tare, fitted from idle periods of the samples
+            drift = DriftModel(cells=len(dout_pins))
+
+            # sample all cells in the background, stopped at exit if close() was not called
+            acquisition = Acquisition(hx711, cells=len(dout_pins), calibration=calibration).start()
+            atexit.register(close)
+    return acquisition
+
+# Stop sampling and wait for the thread, call before GPIO.cleanup(). The next measurement opens the
+# cells again
+def close():
+    global acquisition
+    with lock:
+        if acquisition is not None:
+            acquisition.stop()
+            acquisition = None
+            atexit.unregister(close)
+
+
+# Samples that are not outliers, relative to the median so any load on the bed can be weighed
+def valid(totals):
+    if len(totals) == 0:
+        return np.zeros(0, dtype=bool)
+    return np.abs(totals - np.median(totals)) <= outlier_range
+
+# Totals without the outliers, fails when too many are outliers: the cells are not read reliably
+def kept(totals, seconds):
+    keep = valid(totals)
+    if len(totals) == 0 or keep.sum() < min_valid*len(totals):
+        raise RuntimeError("Only {} of {} load cell samples of the last {} sec within {} g of their median".format(keep.sum(), len(totals), seconds, outlier_range))
+    return totals[keep]
+
+# Mean total of the last seconds of samples, outliers dropped
+def window_mass(seconds):
+    acquisition = get_acquisition()
+    acquisition.wait(seconds)
+    times, totals = acquisition.totals(seconds)
+    return float(np.mean(kept(totals, seconds)))
+
+# Median total of the samples of the last seconds, without waiting or settling, None if there are none.
+# For following the mass on the bed while the printer is moving
+def recent_mass(seconds=recent_window):
+    times, totals = get_acquisition().totals(seconds)
+    totals = totals[valid(totals)]
+    if len(totals) == 0:
+        return None
+    return float(np.median(totals))
+
+# Mean of every cell over the last seconds
+def cell_means(seconds):
+    times, weights = get_acquisition().window(seconds)
+    return weights.mean(axis=0) if len(weights) else np.zeros(len(dout_pins))
 
 def tare(): 
-    # reset ADC, zero it
-    hx711.reset()
-
-    try:
-        hx711.zero(readings_to_average*3) # 30 readings
-        
-        sleep(0.2)
-        
-        raw = hx711.read_raw(readings_to_average*3)
-
-        while None in raw:
-            raw = hx711.read_raw(readings_to_average)
-        else: 
-            weights = hx711.get_weight()
-
-        return sum(weights) # actual 0
-
-    except Exception as e: 
-        print(e)
-
-def measure_mass():
-    values = []
-    last_total = 0
-
-    for i in range(2): # get 2 readings
-        while None in hx711.read_raw(readings_to_average): # Average 10 readings
-            print(hx711.get_weight())
-            # print("None in raw")
-            
-        else: 
-            weights = hx711.get_weight() 
-
-            total = sum(weights)
-
-            print(total)
-            while total > 300 or total < -10 or (total - last_total) > 1: # Filter out outliers and ensure that samples are with in 1g of each other
-                weights = hx711.get_weight() 
-                print(sum(weights))
-
-                last_total = total
-            else: 
-                values.append(total) # Add measurement to array
-
-        # start = perf_counter()
-
-        # while perf_counter() - start <  3: # 4 sec timer
-        #     # Read Raw Data
-            
-        #     raw_vals = hx711.read_raw(readings_to_average*3)
-            
-        #     sleep(0.2)
-
-        #     weights = hx711.get_weight() 
-        #     # print(weights)
-            
-        #     values.append(sum(weights)) # Add measurement to array
-
-        #     # read_duration = perf_counter() - start
+    mass = window_mass(tare_window) # actual 0
+    drift.start(perf_counter(), cell_means(tare_window))
+    return mass
+
+# Reading of the scale once it settled, with its confidence interval. loaded is the perf_counter at
+# which the load was put on the bed (end of the print), the start of settling if None
+def measure(tolerance=settle_tolerance, timeout=settle_timeout, loaded=None):
+    acquisition = get_acquisition()
+    reading = settle(acquisition, tolerance, settle_window, timeout, keep=valid)
+    if reading is None:
+        raise RuntimeError("No valid load cell samples in {} sec".format(timeout))
+    if not reading.settled:
+        kept(acquisition.totals(settle_window)[1], settle_window) # an unsettled reading must at least come from enough samples
+        print("Scale did not settle in {} sec, std {:.3f} g, slope {:.3f} g/sec".format(timeout, reading.std, reading.slope))
+
+    # Record the new load, refit and correct the drift since the tare: the rate since the tare and
+    # the creep of every load since it was placed
+    now = perf_counter()
+    drift.load(loaded if loaded is not None else now - reading.seconds, cell_means(settle_window))
+    drift.update(*acquisition.window())
+    correction = float(drift.drift(now).sum())
+    print("Drift since tare: {:.3f} g".format(correction))
+    return reading._replace(mass=reading.mass - correction)
+
+def measure_mass(tolerance=settle_tolerance, timeout=settle_timeout, loaded=None):
+    reading = measure(tolerance, timeout, loaded)
+
+    print("Average Weight Measurement: {:.3f} +/- {:.3f} g after {:.1f} sec".format(reading.mass, reading.ci, reading.seconds))
+
+    return reading.mass # Avg of measurement over the settled window
 
-    print("Average Weight Measurement: {}".format(sum(values)/len(values)))
-    # print(values)
 
-    return sum(values)/len(values) # Avg of measurement over four seconds
@@ -0,0 +1,44 @@
+import numpy as np
+from collections import namedtuple
+from time import perf_counter, sleep
+
+# Settling Detector
+# Watches the total mass of the acquisition's samples and returns as soon as the scale is stable:
+# over the last window sec the standard deviation and the drift of a fitted line both stay within
+# tolerance. The reading comes with a 95% confidence interval of its mean, so a particle only waits
+# as long as the bed needs to stop moving.
+
+Reading = namedtuple('Reading', ['mass', 'ci', 'std', 'slope', 'samples', 'settled', 'seconds'])
+
+Z95 = 1.96
+
+# Mean, std and slope (g/sec) of totals, None if there are too few samples
+def stats(times, totals, minSamples=5):
+    if len(totals) < minSamples:
+        return None
+    slope = np.polyfit(times - times[0], totals, 1)[0] if times[-1] > times[0] else 0.0
+    return float(np.mean(totals)), float(np.std(totals, ddof=1)), float(slope)
+
+# Block until the samples taken after the call settle within tolerance (g), or timeout (sec).
+# keep(totals) picks the valid samples, outliers are dropped before the test
+def settle(acquisition, tolerance=0.1, window=1.5, timeout=20, keep=None, poll=0.1):
+    start = perf_counter()
+    last = None
+
+    while True:
+        elapsed = perf_counter() - start
+        times, totals = acquisition.totals(min(window, elapsed))
+        if keep is not None:
+            valid = keep(totals)
+            times, totals = times[valid], totals[valid]
+
+        result = stats(times, totals) if elapsed >= window else None
+        if result is not None:
+            mean, std, slope = result
+            last = Reading(mean, float(Z95*std/np.sqrt(len(totals))), std, slope, len(totals), False, elapsed)
+            if std <= tolerance and abs(slope)*window <= tolerance:
+                return last._replace(settled=True)
+
+        if elapsed >= timeout:
+            return last
+        sleep(poll)
@@ -1,181 +1,296 @@
+import math
 from pso.optimize_helpers import Particle, accuracy, consist
 # import numpy as np
-from load_cell.mass import measure_mass, tare
-from gcode_gen.generate import gcode_gen, genStart, genEnd, square_size
-from gcode_sender.printcore_gcode_sender import send_gcode
-from cv.dimensions import image_process, edges, analyze_edge, find_dim
-from time import perf_counter
+from gcode_gen.generate import square_size, cube_size, planePosition, cubePosition
+from gcode_gen.cache import GcodeCache
+from gcode_gen.estimate import estimateGcode
+from cv.dimensions import edges, analyze_edge, find_dim
+from farm import Farm, local_station
+from thermal import ThermalModel, heatingTime, orderParticles
+from time import perf_counter, time
 
 # Settings
 numParticles = 10
+optimizeGcode = True # strip comments and redundant words/moves before sending
+maxPrintTime = {'L': 5*60, 'P': 15*60, 'C': 60*60} # sec, particles estimated to print longer than this are not printed
+timeoutFactor = 2 # send timeout as a multiple of the estimated print time, heating is not estimated
+timeoutMargin = 10*60 # sec, added to the send timeout for heating
+thermal_model = ThermalModel() # hotend model for ordering particles by temperature, refit every iteration
+maxTempError = 15 # deg C, a particle whose hotend stays further than this from Te is cancelled...
+hopelessTime = 30 # sec, ...for this long after reaching it
+filamentDiameter = 1.75 # mm
+filamentDensity = 1.24 # g/cm^3, PLA
+massTrendError = 0.5 # share of the expected mass the mass on the bed may be off by while printing...
+massTrendMargin = 0.3 # g, ...plus this for the noise of the moving printer
+massTrendLag = 32 # lines acknowledged but still queued in the printer, not printed yet
 
 # Execute iteration
-def optimize(mode, xmax, xmin, xguess, mass_desired, numDimensions, iteration): #inputs should be the fitness of last iteration
+# Particles are printed on the stations of farm, by default the local printer only
+def optimize(mode, xmax, xmin, xguess, mass_desired, numDimensions, iteration, farm=None): #inputs should be the fitness of last iteration
     
     # global optimum
     particles = []
-    mass_data = []
-    dimension_data = []
     x_best_g = []
 
+    if farm is None: 
+        farm = Farm([local_station()])
+    farm.reset() # prints were removed before the iteration
+
     # Create Particle Array
     for i in range(0, numParticles):
         # Add new particle to particle array
         particle = Particle(xmax, xmin, xguess, numDimensions)
         particles.append(particle)
 
+    # Footprint of the print
+    size = cube_size if mode == 'C' else square_size
+
     # STARTING THE ITERATION
+
+    # Generate Gcode for every particle, toolpaths are compiled once per (mode, iter) and only the
+    # temperature, speed and flow slots are filled in per particle. Programs already generated by an
+    # earlier run are read from the cache
+    cache = GcodeCache()
+    # Every particle prints at its own position: extruder temperature, travel speed, flow multiplier
+    temps = [int(round(particle.x_i[0])) for particle in particles] # extruder temperature of every particle
+    programs = [cache.program(mode, i + 1, {'moveSpeed': int(round(particles[i].x_i[1])), 'extMult': round(particles[i].x_i[2], 3)}, nozzleD=0.4, Te=temps[i], Tb=0, optimize=optimizeGcode) for i in range(0, numParticles)] # bed is disabled
+
+    # Print in the temperature order with the least heating wait, positions on the bed stay by particle
+    creation = range(0, numParticles)
+    order = orderParticles(temps, thermal_model)
+    predicted = thermal_model.sequenceWait(temps, order)
+    unordered = thermal_model.sequenceWait(temps, creation)
+    print("Temperatures: {}. Print order: {}.".format(temps, [i + 1 for i in order]))
     
-    # For each particle, print and collect data
-    particle_i = 0 # particle index
+    # Print and collect data for every particle, on the next free station
+    def run(station, particle_i): 
+        return evaluate(station, mode, particle_i + 1, cache, programs[particle_i], temps[particle_i], mass_desired, size)
 
-    last_mass = 0 
-
-    for particle in particles:
-
-        iter = particle_i + 1
-        time_start = perf_counter()
-
-
-        # MEASUREMENT STUFF
-
-        # creep = 0.0005*5000/(3*60)*4 # grams/sec * 4 load cells
-
-        zero_weight = 0 
-
-        # Taring
-        if iter == 1: 
-            zero_weight = tare()
-        # print("Initial weight offset: {}".format(zero_weight))
-
-        # Account for Creep - ignoring creep for now
-        initial_zero = zero_weight #- time_zero*creep
-
-
-        # Generate Gcode
-        with open("./gcode_gen/test.gcode", "w") as f:
-            
-            gcode = genStart(iter=iter, nozzleD=0.4, Te=xguess[0], Tb=0) # bed is disabled
-            gcode += gcode_gen(mode, iter, {'moveSpeed': xguess[1], 'extMult': xguess[2]}) # generate gcode with custom parameters
-            gcode += genEnd()
-
-            f.write(gcode)
-        
-        print("Gcode Generated. \n")
-
-        # Tare Weight before Starting Print
-        # time_zero = perf_counter() - time_start
-        # print("Initial weight offset: {}".format(time_zero))
-
-        # Pass in Printing Parameters
-        print("Sending Gcode to Printer. \n")
-        send_gcode(iter, './gcode_gen/test.gcode')
-
-        # measure_time = perf_counter() - time_zero
-
-        # Once print finishes, check weight
-        print("Measuring Mass. \n")
-        mass = measure_mass()
-        mass_real = mass - last_mass - initial_zero # find weight of print
-        mass_data.append(mass_real)
-
-        last_mass = mass
-
-
-        # CV STUFF
-
-        # Find Dimension of the Print
-        print("Starting CV Process. \n")
-        img = image_process() # Process Image
-        edge = edges(img) # Canny Edge Detection
-
-        distX = analyze_edge(edge) # Get the bed x-axis length in terms of pixels
-
-        x=[]
-        y=[]
-
-        # Calculate Print Location
-        if distX is not None:
-            ratio = distX/255 # Pixels per mm
-            print('Ratio: {}'.format(ratio))
-            # Pixel = mm * ratio
-
-            if mode == 'L': 
-                if distX > 0: 
-                    xOffset = 20
-                    x1 = xOffset + round((iter-1)*15*ratio)
-                    x2 = round(x1 + 10*ratio)
-                    x = [x1, x2]
-                    # print(x)
-                    # print(x)
-                    y1 = round(180*ratio) - 20
-                    y2 = round(180*ratio)
-                    y = [y1, y2]
-                else: 
-                    x = [None, None]
-                    y = [None, None]
-
-            if mode == 'P': 
-                if distX: 
-                    initial_gap = 10
-                    gap = 10
-                    x1 = round((initial_gap + gap/2 + (iter-1)*square_size)*ratio)
-                    x2 = round(x1 + (square_size + gap)*ratio)
-                    x = [x1, x2]
-                    # print(x)
-                    yOffset = -5
-                    y1 = round((200 - (square_size + gap + yOffset))*ratio)
-                    y2 = round((200- yOffset)*ratio)
-                    y = [y1, y2]
-                    # print(y)
-                else: 
-                    x = [None, None]
-                    y = [None, None]
-            
-            if mode == 'C': 
-                x = [None, None]
-                y = [None, None]
+    results = [None]*numParticles
+    for particle_i, result in zip(order, farm.map(run, order)): 
+        results[particle_i] = result
 
-        dimensions = find_dim(x, y, distX, edge, iter) # Find dim
+    mass_data = [result[0] if result else None for result in results]
+    dimension_data = [result[1] if result else None for result in results]
+    print("Mass: {}. Dimensions: {}.".format(mass_data, dimension_data))
 
-        if dimensions is not None: 
-            widths = dimensions[0]
-            lengths = dimensions[1]
-            dimension_data.append(dimensions)
-        else: 
-            dimension_data.append(None)
-        
-        # Print all data
-        print("Mass: {}. Dimensions: {}. Time Elasped: {}.".format(mass_data, dimension_data, perf_counter() - time_start))
+    # Heating wait, predicted for this order and for creation order vs measured from the temperature
+    # reports. The measured saving is against the particles that were measured, in creation order, as
+    # predicted by the refitted model
+    timed = [i for i in creation if results[i] and results[i][3] is not None]
+    measured = sum(results[i][3] for i in timed)
+    thermal_model.fit()
+    print("Predicted heating wait: {:.0f} sec, {:.0f} sec saved over creation order. Measured: {:.0f} sec, {:.0f} sec saved.".format(predicted, unordered - predicted, measured, thermal_model.sequenceWait(temps, timed) - measured))
 
+    # PSO STUFF, once every particle has been evaluated
+    f_best_g = None # no global optimum until a particle was printed, rejected particles are skipped
 
-        # PSO STUFF
+    for particle, result in zip(particles, results): 
+        if result is None: 
+            continue # rejected, not printed
 
         # Evaluate and compare particle global optimum to local optimum
-        # Calculate Current Fitness
-        particle.f_best_p = fitness(mode, dimensions[0], dimensions[1], mass, mass_desired, square_size, square_size)
-        print("Fitness: {}".format(particle.f_best_p))
+        particle.f_best_p = result[2]
+        particle.x_best_p = particle.x_i[:] # position it was printed at
 
-        if iter == 1:
+        if f_best_g is None:
             x_best_g = particle.x_best_p[:] # Set global optimum to first particle
             f_best_g = particle.f_best_p # set global optimum to first particle
         else: 
             if particle.f_best_p < f_best_g: # Compare particle fitness to group fitness
                 x_best_g = particle.x_best_p[:] # Splice array and set global op to current particle
+                f_best_g = particle.f_best_p
+
+    for particle, result in zip(particles, results): 
+        if result is None: 
+            continue
 
         # Generate new values for the next iteration based on previous iteration
         particle.updateVelocity(x_best_g)
         particle.updatePosition()
 
         print("Particle Position: {}".format(particle.x_best_p))
-        
-        # NEXT PARTICLE
-        particle_i += 1
 
     print('Iteration {} complete.'.format(iteration))
 
     return particle.x_best_p
 
+# A print is hopeless when the hotend reached Te after since (time()) and has been more than
+# maxTempError away from it for the last hopelessTime sec, the firmware cannot hold the temperature,
+# or when the mass deposited so far (g, None if the scale cannot tell) is off the range expected from
+# the filament pushed (low and high, g: the lines printed for sure and the lines acknowledged),
+# the filament is not coming out or the print came off. Returns the reason, None if it is not hopeless
+def hopeless(telemetry, Te, since, deposited=None, expected=None): 
+    readings = [reading for reading in telemetry.history() if reading[0] >= since and reading[2] == Te]
+    reached = [reading[0] for reading in readings if abs(reading[1] - Te) <= maxTempError]
+    if reached and time() - reached[-1] >= hopelessTime and any(reading[0] >= time() - hopelessTime for reading in readings): 
+        return "hotend off {} C for {} sec".format(Te, hopelessTime)
+
+    if deposited is not None and expected is not None: 
+        low, high = expected
+        if deposited < low*(1 - massTrendError) - massTrendMargin or deposited > high*(1 + massTrendError) + massTrendMargin: 
+            return "{:.2f} g deposited, {:.2f} to {:.2f} g expected".format(deposited, low, high)
+    return None
+
+# Mass of filament, g, for lengths in mm
+def filamentMass(length): 
+    return length*math.pi*(filamentDiameter/2)**2*filamentDensity/1000
+
+# Print one particle on a station and measure it, returns (mass, dimensions, fitness, heating wait),
+# None if the particle was rejected
+def evaluate(station, mode, iter, cache, key, Te, mass_desired, size): 
+    time_start = perf_counter()
+
+
+    # MEASUREMENT STUFF
+
+    # Cubes are too tall to mesh level over or print next to, every cube gets an empty bed
+    if mode == 'C' and station.jobs > 0: 
+        input('{}: Please remove the cube and press enter to continue: \n'.format(station.name))
+        station.reset()
+
+    # Taring, before the first print on the bed of this station. The empty bed reads the station's
+    # zero, the mass on the bed is counted from it
+    if station.jobs == 0: 
+        station.calibrate(zero=station.tare())
+        station.last_mass = station.calibration['zero']
+    # print("Initial weight offset: {}".format(station.calibration['zero']))
+
+    # Creep and drift since the tare are corrected by the scale's drift model
+
+
+    # Gcode for this particle
+    print("{}: Gcode Generated: {}. \n".format(station.name, cache.path(key)))
+
+    # Skip particles that would take too long before spending printer time on them
+    estimate = estimateGcode(cache.lines(key))
+    print("{}: Estimated print time: {:.0f} sec. Filament: {:.1f} mm. \n".format(station.name, estimate.time, estimate.filament))
+
+    if estimate.time > maxPrintTime[mode]: 
+        print("Particle {} rejected, estimated print time over {} sec. \n".format(iter, maxPrintTime[mode]))
+        return None
+
+    # Pass in Printing Parameters
+    print("{}: Sending Gcode to Printer. \n".format(station.name))
+    sent_at = time() # telemetry is timed with time()
+
+    # Mass on the bed expected from the filament pushed by the lines acknowledged so far, line 0 of
+    # the stream is the line number reset
+    expected = filamentMass(estimate.lineFilament)
+    before = station.recent_mass() if station.recent_mass is not None else None
+    acked = [0]
+    def progress(lines): 
+        acked[0] = lines
+
+    aborted = []
+    def abort(): 
+        deposited = None
+        span = None
+        if before is not None and len(expected): 
+            now = station.recent_mass()
+            if now is not None: 
+                deposited = now - before
+                done = min(max(acked[0] - 1, 0), len(expected))
+                span = (expected[done - massTrendLag - 1] if done > massTrendLag else 0, expected[done - 1] if done else 0)
+        reason = hopeless(station.connection.telemetry, Te, sent_at, deposited, span)
+        if reason is not None: 
+            aborted.append(reason)
+            return True
+        return False
+    station.send(iter, cache.lines(key), timeout=estimate.time*timeoutFactor + timeoutMargin, abort=abort, progress=progress)
+    time_end = perf_counter() # the print was put on the bed, its creep starts here
+
+    # Heating wait from the temperature reports: from the M109 target appearing until it is reached
+    heating = heatingTime([reading for reading in station.connection.telemetry.history() if reading[0] >= sent_at], Te)
+    wait = None
+    if heating is not None: 
+        start_temp, seconds = heating
+        thermal_model.observe(start_temp, Te, seconds)
+        wait = seconds + thermal_model.settle
+
+    # Cancelled mid-print, the partial print stays on the bed and is not counted into the next particle
+    if aborted: 
+        print("Particle {} cancelled, {}. \n".format(iter, aborted[0]))
+        station.last_mass = station.measure_mass(loaded=time_end)
+        return None
+
+    # Once print finishes, check weight
+    print("{}: Measuring Mass. \n".format(station.name))
+    mass = station.measure_mass(loaded=time_end)
+    mass_real = mass - station.last_mass # find weight of print
+    station.last_mass = mass
+
+
+    # CV STUFF
+
+    # Find Dimension of the Print
+    print("{}: Starting CV Process. \n".format(station.name))
+    img = station.image_process() # Process Image
+    edge = edges(img) # Canny Edge Detection
+
+    distX = analyze_edge(edge) # Get the bed x-axis length in terms of pixels
+
+    # Bed edge not found, the camera has not moved since the last ratio of this station was measured
+    if distX is None and station.calibration['ratio'] is not None: 
+        distX = station.calibration['ratio']*255
+        print('{}: Bed edge not found, using the last ratio {}'.format(station.name, station.calibration['ratio']))
+    elif distX is not None: 
+        station.calibrate(ratio=distX/255)
+
+    x=[]
+    y=[]
+
+    # Calculate Print Location
+    if distX is not None:
+        ratio = distX/255 # Pixels per mm
+        print('{}: Ratio: {}'.format(station.name, ratio))
+        # Pixel = mm * ratio
+
+        if mode == 'L': 
+            if distX > 0: 
+                xOffset = 20
+                x1 = xOffset + round((iter-1)*15*ratio)
+                x2 = round(x1 + 10*ratio)
+                x = [x1, x2]
+                # print(x)
+                # print(x)
+                y1 = round(180*ratio) - 20
+                y2 = round(180*ratio)
+                y = [y1, y2]
+            else: 
+                x = [None, None]
+                y = [None, None]
+
+        if mode == 'P' or mode == 'C': # planes are placed by planePosition, cubes by cubePosition
+            if distX: 
+                gap = 10
+                TO_X, TO_Y = cubePosition(iter, size) if mode == 'C' else planePosition(iter, size) # front left corner on the bed, mm
+                row = TO_Y - 10 # mm behind the first row, the image's y axis runs towards the front
+                x1 = round((TO_X + gap/2)*ratio)
+                x2 = round(x1 + (size + gap)*ratio)
+                x = [x1, x2]
+                # print(x)
+                yOffset = -5
+                y1 = round((200 - row - (size + gap + yOffset))*ratio)
+                y2 = round((200 - row - yOffset)*ratio)
+                y = [y1, y2]
+                # print(y)
+            else: 
+                x = [None, None]
+                y = [None, None]
+
+    dimensions = find_dim(x, y, distX, edge, iter) # Find dim
+    
+    # Print all data
+    print("{}: Mass: {}. Dimensions: {}. Time Elasped: {}.".format(station.name, mass_real, dimensions, perf_counter() - time_start))
+
+
+    # Calculate Current Fitness
+    f = fitness(mode, dimensions[0], dimensions[1], mass, mass_desired, size, size)
+    print("{}: Fitness: {}".format(station.name, f))
+
+    return (mass_real, dimensions, f, wait)
+
 
 # Fitness Functions
 def fitness(mode, widths, lengths, mass, mass_desired, width_desired, length_desired): # width is a list of measurements for the plane or cube
@@ -185,8 +300,8 @@ def fitness(mode, widths, lengths, mass, mass_desired, width_desired, length_des
     elif mode == "P": 
         return 0.1*accuracy(widths, width_desired)+ 0.1*accuracy(lengths, length_desired) + 0.7*accuracy(mass, mass_desired)
     
-    elif mode == "C":
-        return 0
+    elif mode == "C": # top view only, same as the plane
+        return 0.1*accuracy(widths, width_desired)+ 0.1*accuracy(lengths, length_desired) + 0.7*accuracy(mass, mass_desired)
     
 def average(list): 
     for i in list: 
@@ -18,11 +18,11 @@ class Particle:
 
         # Generate Initial Values
         for i in range(0, numDimensions): 
-            pos = np.random.uniform(max(xguess[i]-r(xmax[i], xmin[i])*p(xmax[i], xmin[i], xguess[i])/2, xmin[i]), min(xguess[i]-r(xmax[i], xmin[i])*p(xmax[i], xmin[i], xguess[i])/2, xmax[i]))
-            self.v_i.append(pos)
+            pos = np.random.uniform(max(xguess[i]-r(xmax[i], xmin[i])*p(xmax[i], xmin[i], xguess[i])/2, xmin[i]), min(xguess[i]+r(xmax[i], xmin[i])*p(xmax[i], xmin[i], xguess[i])/2, xmax[i]))
+            self.x_i.append(pos)
             
             vel = np.random.uniform(-abs(xmax[i]-xmin[i]), abs(xmax[i]-xmin[i]))
-            self.x_i.append(vel)
+            self.v_i.append(vel)
 
     # Functions
 
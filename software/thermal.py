@@ -0,0 +1,82 @@
+import math
+
+# Hotend Thermal Model
+# First order model of the hotend, predicts the M109 wait at the start of every print and orders the
+# particles of an iteration so the waits are as short as possible. It is fitted
+# from the printer's temperature reports: the time from the M109 target appearing until the hotend
+# reaches it, so homing, mesh leveling and the serial link are not taken for heating.
+# Heating runs at full power towards heaterMax with time constant tauHeat, cooling (heater off after
+# genEnd) goes towards ambient with tauCool. Prusa firmware's M109 S only waits when heating, a print
+# that starts hotter than its Te does not wait unless waitCooling is set.
+
+class ThermalModel:
+    def __init__(self, ambient=25, heaterMax=400, tauHeat=127, tauCool=200, idle=60, settle=10, waitCooling=False):
+        self.ambient = ambient # deg C
+        self.heaterMax = heaterMax # temperature the hotend would reach at full power, deg C
+        self.tauHeat = tauHeat # sec
+        self.tauCool = tauCool # sec
+        self.idle = idle # sec between two prints (mass and CV), heater off
+        self.settle = settle # sec, M109 residency time once the temperature is reached
+        self.waitCooling = waitCooling
+        self.samples = [] # (from, to, measured wait) for fit()
+
+    # Temperature after cooling for seconds with the heater off
+    def cool(self, temp, seconds):
+        return self.ambient + (temp - self.ambient)*math.exp(-seconds/self.tauCool)
+
+    # Time M109 waits to go from one temperature to the target, settle included
+    def waitTime(self, temp, target):
+        if temp < target:
+            return self.tauHeat*math.log((self.heaterMax - temp)/(self.heaterMax - target)) + self.settle
+        if self.waitCooling and temp > target:
+            return self.tauCool*math.log((temp - self.ambient)/(target - self.ambient)) + self.settle
+        return self.settle
+
+    # Temperature the next print starts from
+    def startTemp(self, lastTarget):
+        if lastTarget is None:
+            return self.ambient
+        return self.cool(lastTarget, self.idle)
+
+    # Total wait of printing temps in order, starting from the last print's temperature
+    def sequenceWait(self, temps, order, lastTarget=None):
+        total = 0
+        for i in order:
+            total += self.waitTime(self.startTemp(lastTarget), temps[i])
+            lastTarget = temps[i]
+        return total
+
+    # Hotend went from temp to target in seconds, settle not included
+    def observe(self, temp, target, seconds):
+        self.samples.append((temp, target, seconds))
+
+    # Least squares time constants from the observed heating times, seconds = tau * log ratio
+    def fit(self):
+        heat = [(t, math.log((self.heaterMax - a)/(self.heaterMax - b))) for a, b, t in self.samples if a < b]
+        if heat and sum(l*l for t, l in heat) > 0:
+            self.tauHeat = sum(t*l for t, l in heat) / sum(l*l for t, l in heat)
+
+        if self.waitCooling:
+            cool = [(t, math.log((a - self.ambient)/(b - self.ambient))) for a, b, t in self.samples if a > b]
+            if cool and sum(l*l for t, l in cool) > 0:
+                self.tauCool = sum(t*l for t, l in cool) / sum(l*l for t, l in cool)
+
+# (start temperature, sec to reach target) of the first M109 in temperature readings (time, hotend,
+# hotend target, ...) from the printer, None if the target was not set or not reached in them.
+# Reached is within tolerance deg C of the target
+def heatingTime(readings, target, tolerance=1):
+    start = None
+    for reading in readings:
+        if start is None:
+            if abs(reading[2] - target) < 0.5:
+                start = reading
+        elif abs(reading[1] - target) <= tolerance:
+            return start[1], reading[0] - start[0]
+    return None
+
+# Order of the particles (indexes into temps) with the least predicted wait: ascending or
+# descending temperature, whichever the model prefers
+def orderParticles(temps, model, lastTarget=None):
+    ascending = sorted(range(len(temps)), key=lambda i: temps[i])
+    descending = ascending[::-1]
+    return min([ascending, descending], key=lambda order: model.sequenceWait(temps, order, lastTarget))